@@ -0,0 +1,132 @@
+"""
+End-to-end throughput benchmark of main_batch. Runs a fixed subset of the samples of the configured dataset (MyDataset,
+TiM, ...) with fixed code from cached_code/ (no code generation), against the real models or their simulation (see
+simulated_models.py), and reports:
+    - samples per second, once the models are loaded
+    - p50/p95/p99 latency of the API methods (find, simple_query, face_identify, llm_query, select_answer) and of the
+      whole programs (execute_command)
+    - time that the requests waited in the queues of the model consumers (multiprocessing only)
+    - peak resident memory of the main process and of the largest child process
+The result is appended to a json lines file with the commit, so that regressions can be found across commits.
+
+Usage:
+    CONFIG_NAMES=ablations/v_120_blip2_df_gpt35_simple_mainset python bench.py --simulated
+    CONFIG_NAMES=... python bench.py --samples 100 --simulated glip blip --output results/bench.jsonl
+"""
+
+import argparse
+import json
+import os
+import resource
+import time
+
+import numpy as np
+import torch.multiprocessing as mp
+from rich.console import Console
+from rich.table import Table
+
+from configs import config
+from import_time import git_commit
+
+console = Console(highlight=False)
+
+default_simulated = ['glip', 'blip', 'deepface', 'gpt3', 'codex']
+
+
+def summarize(seconds):
+    seconds = np.array(seconds)
+    return {'count': len(seconds), 'mean': float(seconds.mean()), 'p50': float(np.percentile(seconds, 50)),
+            'p95': float(np.percentile(seconds, 95)), 'p99': float(np.percentile(seconds, 99))}
+
+
+def queue_waits(queue_stats) -> dict:
+    """Wait in the queue of every model, joining its consumer processes (replicas)"""
+    waits = {}
+    for key, seconds in dict(queue_stats).items():
+        waits.setdefault(key.split('/')[0], []).extend(seconds)
+    return {name: summarize(seconds) for name, seconds in waits.items() if len(seconds) > 0}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux. For the children, it is the largest of the finished ones (the workers and the
+    # consumers are finished at the end of main_batch.main)
+    return {'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'largest_child': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def print_table(title, rows: dict):
+    table = Table(title=title)
+    for column in ['', 'count', 'mean (s)', 'p50 (s)', 'p95 (s)', 'p99 (s)']:
+        table.add_column(column, justify='left' if column == '' else 'right')
+    for name, s in rows.items():
+        table.add_row(name, str(s['count']), *[f'{s[k]:.3f}' for k in ['mean', 'p50', 'p95', 'p99']])
+    console.print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of main_batch')
+    parser.add_argument('--samples', type=int, default=50, help='Number of samples (the first ones of the dataset)')
+    parser.add_argument('--code', default='./cached_code/v_df_gpt35_simple/v1.csv',
+                        help='Results file with the code to run for every sample')
+    parser.add_argument('--simulated', nargs='*', default=None,
+                        help=f'Use the simulation of these models (all of {default_simulated} if none is given)')
+    parser.add_argument('--output', default='results/bench.jsonl', help='File to append the results to')
+    args = parser.parse_args()
+
+    # Only the settings read by the main process can be changed here. The models and the workers read the config files
+    config.dataset.max_samples = args.samples
+    config.dataset.start_sample = 0
+    config.use_cached_codex = True
+    config.cached_codex_path = args.code
+    config.save = False
+    config.wandb = False
+    if args.simulated is not None:
+        config.simulation.models = args.simulated or default_simulated
+
+    # Load the models first, so that the loading time is not counted in the throughput
+    mp.set_start_method('spawn')
+    start_time = time.time()
+    from vision_processes import model_stats, queue_stats
+    startup_seconds = time.time() - start_time
+
+    import main_batch
+    start_time = time.time()
+    run = main_batch.main()
+    seconds = time.time() - start_time
+
+    methods = {name: summarize(s) for name, s in sorted(run['timings'].items()) if len(s) > 0}
+    waits = queue_waits(queue_stats) if queue_stats is not None else {}
+    record = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'config_names': os.getenv('CONFIG_NAMES', None),
+        'multiprocessing': config.multiprocessing,
+        'simulated': list(config.simulation.models),
+        'samples': run['num_samples'],
+        'startup_seconds': startup_seconds,
+        'seconds': seconds,
+        'samples_per_second': run['num_samples'] / seconds,
+        'methods': methods,
+        'queue_wait': waits,
+        'peak_rss_mb': peak_rss_mb(),
+        'llm_usage': dict(run['llm_usage']),
+        'model_stats': {} if model_stats is None else dict(model_stats),
+    }
+
+    console.print(f'{record["samples"]} samples in {seconds:.1f}s: {record["samples_per_second"]:.2f} samples/s '
+                  f'(models loaded in {startup_seconds:.1f}s)')
+    print_table('API methods', methods)
+    if len(waits) > 0:
+        print_table('Wait in the model queues', waits)
+    console.print(f'Peak RSS: {record["peak_rss_mb"]["main"]:.0f}MB (main), '
+                  f'{record["peak_rss_mb"]["largest_child"]:.0f}MB (largest child process)')
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        console.print(f'Results appended to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
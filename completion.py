@@ -0,0 +1,51 @@
+"""
+Detection of the execute_command function in the (possibly partial) code generated by the language models, so that a
+streamed completion can be stopped as soon as the function is complete (see vision_models.stream_completion).
+"""
+
+import ast
+
+
+def complete_function(text):
+    """
+    The execute_command function in a (possibly partial) completion, once it is complete and it parses. None otherwise.
+    The function is complete when its code block is closed, or, without code block, when a line after its body is not
+    indented (e.g. more code, or prose explaining it). Comments are not the end, nor lines inside an open string or
+    bracket: the function must parse without that line.
+    """
+    if '```' in text:
+        blocks = text.split('```')
+        if len(blocks) < 3:
+            return None
+        code = blocks[1]
+        if code.startswith('python'):
+            code = code[len('python'):]
+    else:
+        lines = text.split('\n')
+        start = next((i for i, line in enumerate(lines) if line.startswith('def execute_command')), None)
+        if start is None:
+            return None
+        # The last line may still be incomplete
+        for end in range(start + 1, len(lines) - 1):
+            line = lines[end]
+            if not line.strip() or line[0].isspace() or line.startswith('#'):
+                continue
+            last = end
+            while not lines[last - 1].strip() or lines[last - 1].startswith('#'):  # Not part of the function
+                last -= 1
+            code = '\n'.join(lines[start:last])
+            # Inside an open string or bracket the code before the line does not parse
+            if defines_execute_command(code):
+                return code
+        return None
+    return code if defines_execute_command(code) else None
+
+
+def defines_execute_command(code):
+    """Whether code parses and defines execute_command. Code blocks markers are ignored"""
+    code = code.replace('```python', '').replace('```', '')
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    return any(isinstance(node, ast.FunctionDef) and node.name == 'execute_command' for node in tree.body)
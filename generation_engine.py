@@ -0,0 +1,189 @@
+"""
+Local text generation for decoder-only language models (used by the codellama backend), with continuous batching:
+prompts can be submitted from any thread at any time, and they join the batch that is being decoded as soon as there
+is room, instead of waiting for the whole batch to finish. The key/value cache of the static prefix shared by all the
+prompts (API specification and examples) is computed once, so only the part of every prompt after it is processed.
+Generation runs on the device of the model, so it can be tried on CPU with a tiny checkpoint.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+
+def to_legacy_cache(past):
+    """Key/value cache as a tuple with a (key, value) pair per layer, of shape [batch, heads, length, head_dim]"""
+    return past.to_legacy_cache() if hasattr(past, 'to_legacy_cache') else past
+
+
+def from_legacy_cache(past):
+    try:
+        from transformers import DynamicCache
+    except ImportError:  # Older versions of transformers take the tuples directly
+        return past
+    return DynamicCache.from_legacy_cache(past)
+
+
+def left_pad(past, mask, length):
+    """Pads the cache and attention mask on the left (masked out) up to the given length"""
+    pad = length - mask.shape[1]
+    if pad == 0:
+        return past, mask
+    past = tuple((torch.nn.functional.pad(k, (0, 0, pad, 0)), torch.nn.functional.pad(v, (0, 0, pad, 0)))
+                 for k, v in past)
+    return past, torch.nn.functional.pad(mask, (pad, 0))
+
+
+class Sequence:
+    def __init__(self, input_ids, future, reuse_prefix=True):
+        self.input_ids = input_ids  # Prompt tokens after the prefix, or all of them if not reuse_prefix
+        self.future = future
+        self.reuse_prefix = reuse_prefix
+        self.generated = []
+
+
+class GenerationEngine:
+    """
+    Greedy generation with continuous batching. Submitted prompts are completed (after `prefix`) until the end of
+    sequence token, `stop`, or max_new_tokens. The text is returned up to `stop`.
+    """
+
+    def __init__(self, model, tokenizer, prefix='', max_batch_size=8, max_new_tokens=128, stop='\n\n'):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop
+        self.pending = deque()
+        self.condition = threading.Condition()
+
+        # Batch being decoded. The caches of the sequences are padded on the left to the same length
+        self.active = []
+        self.past = None
+        self.attention_mask = None
+        self.next_tokens = None  # Last generated token of every sequence, which is not in the cache yet
+
+        self.set_prefix(prefix)
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    @torch.no_grad()
+    def set_prefix(self, prefix):
+        """Computes the key/value cache of the prefix shared by all the prompts"""
+        self.prefix = prefix
+        self.prefix_ids = self.tokenizer(prefix, return_tensors='pt')['input_ids'].to(self.device)
+        out = self.model(input_ids=self.prefix_ids, use_cache=True)
+        self.prefix_past = to_legacy_cache(out.past_key_values)
+
+    def submit(self, prompt) -> Future:
+        """Queues the prompt (the text after the prefix). The future gets the generated text"""
+        future = Future()
+        # The whole text is tokenized, as the model would see it without the engine. Tokenizers like SentencePiece
+        # merge tokens across the boundary, so the prefix cache is only used if the prefix tokens are the same
+        input_ids = self.tokenizer(self.prefix + prompt)['input_ids']
+        prefix_ids = self.prefix_ids[0].tolist()
+        if input_ids[:len(prefix_ids)] == prefix_ids:
+            sequence = Sequence(input_ids[len(prefix_ids):], future)
+        else:
+            sequence = Sequence(input_ids, future, reuse_prefix=False)
+        with self.condition:
+            self.pending.append(sequence)
+            self.condition.notify()
+        return future
+
+    def generate(self, prompts: list) -> list:
+        futures = [self.submit(prompt) for prompt in prompts]
+        return [future.result() for future in futures]
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and len(self.active) == 0:
+                    self.condition.wait()
+                admitted = []
+                while len(self.pending) > 0 and len(self.active) + len(admitted) < self.max_batch_size:
+                    admitted.append(self.pending.popleft())
+            # A sequence that fails to be admitted (e.g. too long) only fails itself. A failed step fails the batch
+            for sequence in admitted:
+                try:
+                    self.admit(sequence)
+                except Exception as e:
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+            try:
+                if len(self.active) > 0:
+                    self.step()
+            except Exception as e:
+                for sequence in self.active:
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+                self.active, self.past, self.attention_mask, self.next_tokens = [], None, None, None
+
+    @torch.no_grad()
+    def admit(self, sequence):
+        """Processes the prompt of the sequence on top of the prefix cache, and adds it to the batch. The batch is only
+        modified once everything is computed, so if this fails the other sequences are not affected"""
+        prefix_length = self.prefix_ids.shape[1] if sequence.reuse_prefix else 0
+        input_ids = torch.tensor([sequence.input_ids], device=self.device, dtype=torch.long)
+        length = prefix_length + input_ids.shape[1]
+        mask = torch.ones(1, length, device=self.device, dtype=torch.long)
+        position_ids = torch.arange(prefix_length, length, device=self.device)[None]
+        past = from_legacy_cache(self.prefix_past) if sequence.reuse_prefix else None
+        out = self.model(input_ids=input_ids, past_key_values=past, attention_mask=mask, position_ids=position_ids,
+                         use_cache=True)
+        token = out.logits[0, -1].argmax(-1)
+        if self.advance(sequence, token.item()):
+            return
+        past = to_legacy_cache(out.past_key_values)
+        if len(self.active) == 0:
+            batch_past, attention_mask, next_tokens = past, mask, token.view(1, 1)
+        else:
+            length = max(mask.shape[1], self.attention_mask.shape[1])
+            past, mask = left_pad(past, mask, length)
+            batch_past, attention_mask = left_pad(self.past, self.attention_mask, length)
+            batch_past = tuple((torch.cat([k_b, k]), torch.cat([v_b, v]))
+                               for (k_b, v_b), (k, v) in zip(batch_past, past))
+            attention_mask = torch.cat([attention_mask, mask])
+            next_tokens = torch.cat([self.next_tokens, token.view(1, 1)])
+        self.past, self.attention_mask, self.next_tokens = batch_past, attention_mask, next_tokens
+        self.active.append(sequence)
+
+    @torch.no_grad()
+    def step(self):
+        """Decodes one token for every sequence in the batch, and removes the finished ones"""
+        self.attention_mask = torch.cat([self.attention_mask, torch.ones_like(self.next_tokens)], dim=1)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True) - 1
+        out = self.model(input_ids=self.next_tokens, past_key_values=from_legacy_cache(self.past),
+                         attention_mask=self.attention_mask, position_ids=position_ids, use_cache=True)
+        self.past = to_legacy_cache(out.past_key_values)
+        self.next_tokens = out.logits[:, -1].argmax(-1, keepdim=True)
+
+        keep = [i for i, (sequence, token) in enumerate(zip(self.active, self.next_tokens[:, 0].tolist()))
+                if not self.advance(sequence, token)]
+        if len(keep) < len(self.active):
+            self.active = [self.active[i] for i in keep]
+            index = torch.tensor(keep, device=self.device, dtype=torch.long)
+            self.attention_mask = self.attention_mask[index]
+            self.next_tokens = self.next_tokens[index]
+            # Columns that are padding for all the remaining sequences are not needed anymore
+            start = int((self.attention_mask.sum(dim=0) > 0).nonzero()[0]) if len(keep) > 0 else 0
+            self.attention_mask = self.attention_mask[:, start:]
+            self.past = tuple((k[index, :, start:], v[index, :, start:]) for k, v in self.past)
+
+    def advance(self, sequence, token):
+        """Adds the token to the sequence. Returns True (and sets the result) if the sequence is finished"""
+        finished = token == self.tokenizer.eos_token_id
+        if not finished:
+            sequence.generated.append(token)
+            finished = len(sequence.generated) >= self.max_new_tokens
+            if not finished and '\n' in self.tokenizer.decode([token]):
+                finished = self.stop in self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+        if finished:
+            text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+            sequence.future.set_result(text.split(self.stop)[0])
+        return finished
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import numpy as np
+import os
 import re
 import torch
 from dateutil import parser as dateparser
@@ -11,7 +12,7 @@ from torchvision.ops import box_iou
 from typing import Union, List
 from word2number import w2n
 
-from utils import show_single_image, load_json
+from utils import show_single_image, load_json, hash_tensor, timed
 from vision_processes import forward, config
 
 console = Console(highlight=False)
@@ -131,11 +132,44 @@ class ImagePatch:
 
     @property
     def original_image(self):
+        return self.root_patch.cropped_image
+
+    @property
+    def root_patch(self):
         if self.parent_img_patch is None:
-            return self.cropped_image
+            return self
         else:
-            return self.parent_img_patch.original_image
-
+            return self.parent_img_patch.root_patch
+
+    def depth_map(self) -> torch.Tensor:
+        """Returns the depth map of the original image. It is computed once and shared by all the patches cropped
+        from the same original image. If config.depth_cache_dir is set, it is also stored on disk"""
+        root = self.root_patch
+        if 'depth' not in root.cache:
+            path = None
+            if config.depth_cache_dir:
+                path = os.path.join(config.depth_cache_dir, hash_tensor(root.cropped_image) + '.pt')
+            if path is not None and os.path.exists(path):
+                try:
+                    root.cache['depth'] = torch.load(path)
+                except Exception as e:  # Unreadable file: computed again, and replaced
+                    print(f'Could not read the depth map {path}: {e}')
+            if 'depth' not in root.cache:
+                root.cache['depth'] = self.forward('depth', root.cropped_image)
+                if path is not None:
+                    # Written to a temporary file and renamed, so that other workers never read a partial file
+                    os.makedirs(config.depth_cache_dir, exist_ok=True)
+                    tmp_path = f'{path}.{os.getpid()}.tmp'
+                    torch.save(root.cache['depth'], tmp_path)
+                    os.replace(tmp_path, path)
+        return root.cache['depth']
+
+    def depth_crop(self) -> torch.Tensor:
+        """Returns the crop of the depth map corresponding to this patch"""
+        height = self.original_image.shape[1]
+        return self.depth_map()[height-self.upper:height-self.lower, self.left:self.right]
+
+    @timed('find')
     def find(self, object_name: str) -> list[ImagePatch]:
         """Returns a list of ImagePatch objects matching object_name contained in the crop if any are found.
         Otherwise, returns an empty list.
@@ -265,6 +299,7 @@ class ImagePatch:
 
         return option_list[selected]
 
+    @timed('simple_query')
     def simple_query(self, question: str, to_yesno: bool = False) -> str:
         """Returns the answer to a basic question asked about the image. If no question is provided, returns the answer
         to "What is this?". The questions are about basic perception, and are not meant to be used for complex reasoning
@@ -278,7 +313,9 @@ class ImagePatch:
         """
         if to_yesno:
             question = question + "please answer with 'yes' or 'no'"
-        answer = self.forward(config.vqa_model, self.cropped_image, question, task='qa')
+        # Yes/no questions use a cheaper decoding in the models that support it
+        task = 'yesno' if to_yesno else 'qa'
+        answer = self.forward(config.vqa_model, self.cropped_image, question, task=task)
         # if to_yesno:
         #     answer = answer.lower()
         #     if 'yes' in answer:
@@ -299,10 +336,7 @@ class ImagePatch:
         float
             the median depth of the image crop
         """
-        original_image = self.original_image
-        depth_map = self.forward('depth', original_image)
-        depth_map = depth_map[original_image.shape[1]-self.upper:original_image.shape[1]-self.lower,
-                              self.left:self.right]
+        depth_map = self.depth_crop()
         return depth_map.median()  # Ideally some kind of mode, but median is good enough for now
 
     def crop(self, left: int, lower: int, right: int, upper: int) -> ImagePatch:
@@ -406,6 +440,28 @@ def best_image_match(list_patches: list[ImagePatch], content: List[str], return_
     return list_patches[scores]
 
 
+def compute_depths(list_patches: list[ImagePatch]) -> torch.Tensor:
+    """Returns the median depth of every patch in the list. Equivalent to calling compute_depth on every patch, but the
+    depth model runs once per original image and the medians are computed together.
+    Parameters
+    ----------
+    list_patches : List[ImagePatch]
+
+    Returns
+    -------
+    torch.Tensor
+        the median depth of each patch
+    """
+    if len(list_patches) == 0:
+        return torch.tensor([])
+    crops = [patch.depth_crop().flatten() for patch in list_patches]
+    max_len = max(len(crop) for crop in crops)
+    padded = torch.full((len(crops), max_len), float('nan'), dtype=crops[0].dtype)
+    for i, crop in enumerate(crops):
+        padded[i, :len(crop)] = crop
+    return padded.nanmedian(dim=1).values
+
+
 def distance(patch_a: Union[ImagePatch, float], patch_b: Union[ImagePatch, float]) -> float:
     """
     Returns the distance between the edges of two ImagePatches, or between two floats.
@@ -449,6 +505,7 @@ def bool_to_yesno(bool_answer: bool) -> str:
     return "yes" if bool_answer else "no"
 
 
+@timed('llm_query')
 def llm_query(query, context=None, long_answer=True, queues=None, to_yesno=False):
     """Answers a text question using GPT-3. The input question is always a formatted string with a variable in it.
 
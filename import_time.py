@@ -0,0 +1,78 @@
+"""
+Measures how long it takes to import the modules loaded at startup, with a per-package breakdown (from
+`python -X importtime`), and appends the result to a json lines file so that it can be tracked across commits.
+
+Usage:
+    python import_time.py                       # vision_models and main_batch
+    python import_time.py vision_models --top 30
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from rich.console import Console
+from rich.table import Table
+
+console = Console(highlight=False)
+
+
+def import_times(module):
+    """Returns the cumulative import time of module, and the self import time of every top-level package, in seconds"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f'Could not import {module}:\n{out.stderr[-2000:]}')
+    total = 0.
+    per_package = Counter()
+    # Every line looks like "import time:       123 |        456 |   package.submodule"
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        per_package[name.split('.')[0]] += int(self_us) / 1e6
+        if name == module:
+            total = int(cumulative_us) / 1e6
+    return total, per_package
+
+
+def git_commit():
+    out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True)
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('modules', nargs='*', default=['vision_models', 'main_batch'])
+    parser.add_argument('--top', type=int, default=15, help='Number of packages to show')
+    parser.add_argument('--output', default='results/import_time.jsonl', help='File to append the results to')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    records = []
+    for module in args.modules:
+        total, per_package = import_times(module)
+        top_packages = dict(per_package.most_common(args.top))
+
+        table = Table(title=f'import {module}: {total:.2f}s')
+        table.add_column('package')
+        table.add_column('self time (s)', justify='right')
+        for package, seconds in top_packages.items():
+            table.add_row(package, f'{seconds:.3f}')
+        console.print(table)
+
+        records.append({'commit': commit, 'timestamp': time.time(), 'module': module, 'total': total,
+                        'packages': top_packages})
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        console.print(f'Results appended to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Deadlines and request hedging for the calls to hosted language models (OpenAI, Gemini). The latency of these calls has
+a long tail, so with config.llm_client.hedge a duplicate of a request is sent once it has taken longer than usual (the
+config.llm_client.hedge_quantile of the recent latencies), and the first response is used. Every call also has a
+deadline (config.llm_client.deadline), after which DeadlineExceeded is raised and the caller can retry.
+
+The requests run in daemon threads: a request that missed its deadline or lost against its duplicate is abandoned, not
+interrupted.
+
+The usage of every call (tokens, seconds and cost, with the prices in config.llm_usage.prices) is recorded by the
+client. To attribute it to whoever made the request, the usage recorded during a block of code is collected with
+`metering()`. The consumers of vision_processes send it back with the output (Metered), and forward() adds it to the
+meter of the caller, so the usage can be known per sample and per run, across processes.
+
+Abandoned requests are still billed. Their usage is recorded in their thread when they finish: if that is after the call
+returned, it is added to the meter of the next call of the client.
+"""
+
+import contextlib
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import numpy as np
+
+from configs import config
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Metered:
+    """Output of a model call, with the usage ({process name: counters}) it took"""
+
+    def __init__(self, value, usage):
+        self.value = value
+        self.usage = usage
+
+
+_meters = threading.local()
+
+
+@contextlib.contextmanager
+def metering():
+    """
+    Collects, in a {process name: Counter} dict, the usage recorded in this thread inside the block. Meters can be
+    nested: the usage only goes to the innermost one
+    """
+    if not hasattr(_meters, 'stack'):
+        _meters.stack = []
+    usage = defaultdict(Counter)
+    _meters.stack.append(usage)
+    try:
+        yield usage
+    finally:
+        _meters.stack.pop()
+
+
+def merge_usage(target: dict, usage: dict):
+    """Adds usage ({process name: counters}) to target (a {process name: Counter} defaultdict)"""
+    for name, counters in usage.items():
+        target[name].update(counters)
+
+
+def add_usage(usage: dict):
+    """Adds usage to the innermost meter of this thread, if any"""
+    stack = getattr(_meters, 'stack', [])
+    if len(stack) > 0:
+        merge_usage(stack[-1], usage)
+
+
+def unwrap(out):
+    """Value of a model output. If it is Metered, its usage is added to the meter of this thread"""
+    if isinstance(out, Metered):
+        add_usage(out.usage)
+        return out.value
+    return out
+
+
+def without_usage(out):
+    """For outputs sent to more than one request (coalesced requests), so that the usage is only counted once"""
+    return out.value if isinstance(out, Metered) else out
+
+
+def total_usage(usage: dict) -> Counter:
+    total = Counter()
+    for counters in usage.values():
+        total.update(counters)
+    return total
+
+
+def cost(model, prompt_tokens, completion_tokens):
+    """Cost in USD. 0 for models without a price in config.llm_usage.prices (USD per 1K prompt/completion tokens)"""
+    prices = config.llm_usage.prices.get(model, None)
+    if prices is None:
+        return 0.
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+
+def over_budget(usage: Counter):
+    """Whether the (total) usage exceeds the budget of the run in config.llm_usage"""
+    budget_usd, budget_tokens = config.llm_usage.budget_usd, config.llm_usage.budget_tokens
+    tokens = usage['prompt_tokens'] + usage['completion_tokens']
+    return (budget_usd is not None and usage['cost_usd'] >= budget_usd) or \
+        (budget_tokens is not None and tokens >= budget_tokens)
+
+
+class LLMClient:
+    """Runs the calls to one model, keeping the latency statistics used to decide when to hedge"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=config.llm_client.latency_window)  # Of single requests that succeeded
+        self.counters = Counter()
+        self.saved_seconds = 0.
+        self.usage = Counter()
+        self.models = set()
+        self.late_usage = Counter()  # Of requests that finished after their call returned
+
+    def submit(self, fn, args, kwargs, usage_of=None) -> Future:
+        """Runs fn in a thread. With usage_of, the usage of the response is recorded as soon as it arrives (future.usage,
+        or late_usage if the call already returned)"""
+        future = Future()
+        future.start_time = time.time()
+        future.abandoned = False
+
+        def run():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.end_time = time.time()
+                future.set_exception(e)
+                return
+            if usage_of is not None:
+                try:
+                    self.record_request_usage(future, *usage_of(result), time.time() - future.start_time)
+                except Exception as e:  # The response is still used
+                    print(f'Could not record the usage of a {self.name} response: {e}')
+            future.end_time = time.time()
+            future.set_result(result)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def hedge_delay(self):
+        """Seconds after which a duplicate request is sent. None if hedging is disabled or there is not enough data"""
+        if not config.llm_client.hedge:
+            return None
+        with self.lock:
+            if len(self.latencies) < config.llm_client.min_samples:
+                return None
+            return float(np.quantile(self.latencies, config.llm_client.hedge_quantile))
+
+    def call(self, fn, *args, usage_of=None, **kwargs):
+        """
+        Returns fn(*args, **kwargs), hedged and with the deadline of config.llm_client.deadline. usage_of(response)
+        returns the (model, prompt tokens, completion tokens) of a response, to record the usage of every request sent,
+        including the duplicates and the abandoned ones
+        """
+        deadline = config.llm_client.deadline
+        start_time = time.time()
+        self.add_late_usage()
+        futures = [self.submit(fn, args, kwargs, usage_of)]
+        futures[0].add_done_callback(self.record_latency)
+        try:
+            hedge_delay = self.hedge_delay()
+            if hedge_delay is not None and (deadline is None or hedge_delay < deadline):
+                done, _ = wait(futures, timeout=hedge_delay)
+                if len(done) == 0:
+                    futures.append(self.submit(fn, args, kwargs, usage_of))
+                    futures[1].add_done_callback(self.record_latency)
+                    self.count('hedged')
+
+            pending = set(futures)
+            error = None
+            while len(pending) > 0:
+                timeout = None if deadline is None else max(0., deadline - (time.time() - start_time))
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    break
+                for future in done:
+                    if future.exception() is None:
+                        self.count('requests')
+                        if future is not futures[0]:
+                            self.count('hedge_wins')
+                            # Time saved: known once the original request finishes
+                            futures[0].add_done_callback(
+                                lambda original, hedge=future: self.record_saved(original, hedge))
+                        return future.result()
+                    error = future.exception()
+            self.count('requests')
+            if error is not None and len(pending) == 0:
+                self.count('errors')
+                raise error
+            self.count('deadline_exceeded')
+            raise DeadlineExceeded(f'{self.name} request did not finish in {deadline} seconds')
+        finally:
+            self.collect_usage(futures)
+
+    def record_request_usage(self, future, model, prompt_tokens, completion_tokens, seconds):
+        """Usage of a request, from its thread. It goes to the meter of the call, or to late_usage if it returned"""
+        usage = self.usage_counters(model, prompt_tokens, completion_tokens, seconds)
+        with self.lock:
+            self.usage.update(usage)
+            self.models.add(model)
+            if future.abandoned:
+                self.late_usage.update(usage)
+            else:
+                future.usage = usage
+
+    def collect_usage(self, futures):
+        """Adds the usage of the requests of a call to the meter of this thread. Requests still running are abandoned:
+        their usage will go to late_usage"""
+        usage = Counter()
+        with self.lock:
+            for future in futures:
+                if hasattr(future, 'usage'):
+                    usage.update(future.usage)
+                else:
+                    future.abandoned = True
+        if len(usage) > 0:
+            add_usage({self.name: usage})
+
+    def add_late_usage(self):
+        with self.lock:
+            usage, self.late_usage = self.late_usage, Counter()
+        if len(usage) > 0:
+            add_usage({self.name: usage})
+
+    def record_latency(self, future):
+        if future.exception() is None:
+            with self.lock:
+                self.latencies.append(future.end_time - future.start_time)
+
+    def record_saved(self, original, hedge):
+        if original.exception() is None:
+            with self.lock:
+                self.saved_seconds += max(0., original.end_time - hedge.end_time)
+
+    @staticmethod
+    def usage_counters(model, prompt_tokens, completion_tokens, seconds):
+        return {'llm_calls': 1, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'llm_seconds': seconds, 'cost_usd': cost(model, prompt_tokens, completion_tokens)}
+
+    def record_usage(self, model, prompt_tokens, completion_tokens, seconds):
+        """Records the usage of a call made without call(), in the statistics of the client and in the meter of this
+        thread"""
+        usage = self.usage_counters(model, prompt_tokens, completion_tokens, seconds)
+        with self.lock:
+            self.usage.update(usage)
+            self.models.add(model)
+        add_usage({self.name: usage})
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = {**self.counters, **self.usage}
+            if len(self.models) > 0:
+                stats['models'] = sorted(self.models)
+            if self.counters['hedged'] > 0:
+                stats['hedge_rate'] = self.counters['hedged'] / max(1, self.counters['requests'])
+                stats['hedge_saved_seconds'] = self.saved_seconds
+        if len(latencies) > 0:
+            stats.update({'latency_p50': float(np.percentile(latencies, 50)),
+                          'latency_p95': float(np.percentile(latencies, 95))})
+        return stats
@@ -1,9 +1,12 @@
 import json
 import os
 import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import warnings
 import traceback
+from collections import Counter, defaultdict
 
 import pandas as pd
 import torch.multiprocessing as mp
@@ -14,7 +17,8 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from configs import config
-from utils import format_dict, seed_everything
+from llm_client import merge_usage, metering, over_budget, total_usage
+from utils import format_dict, seed_everything, timing
 import datasets
 
 # See https://github.com/pytorch/pytorch/issues/11201, https://github.com/pytorch/pytorch/issues/973
@@ -34,22 +38,61 @@ def my_collate(batch):
     return to_return
 
 
+def program_code(code, sample_id, input_type_):
+    """Code that run_program executes for the generated code"""
+    code_header = f'def execute_command_{sample_id}(' \
+                  f'{input_type_}, annotation, possible_answers, query, ' \
+                  f'ImagePatch, VideoSegment, ' \
+                  'llm_query, bool_to_yesno, distance, best_image_match, compute_depths):\n' \
+                  f'    # Answer is:'
+
+    code = code.replace('```', '').replace('python', '')
+    return code_header + code.strip()
+
+
+def compilation_error(code, sample_id, input_type_):
+    try:
+        compile(program_code(code, sample_id, input_type_), 'Codex', 'exec')
+    except Exception as e:
+        return str(e)
+    return ''
+
+
+def regenerate(codex, codes, invalid, batch, input_type_):
+    """
+    Requests new code for the samples in `invalid` (whose code does not compile) until it compiles, up to
+    config.codex.max_regenerations times. config.codex.regeneration_temperature is used, so that the new code is
+    different. Returns the final code of those samples, and the language model usage of the requests.
+    """
+    codes = list(codes)
+    regenerated = list(invalid)
+    with metering() as usage:
+        for _ in range(config.codex.max_regenerations):
+            if len(invalid) == 0:
+                break
+            new_codes, _ = codex(prompt=[batch['query'][j] for j in invalid], input_type=input_type_,
+                                 extra_context=[batch['extra_context'][j] for j in invalid],
+                                 temperature=config.codex.regeneration_temperature)
+            for j, c in zip(invalid, new_codes):
+                codes[j] = c
+            invalid = [j for j in invalid if compilation_error(codes[j], batch['sample_id'][j], input_type_)]
+    return [codes[j] for j in regenerated], usage
+
+
+def split_usage(usage, n):
+    """Usage of a request made for n samples, attributed equally to each of them"""
+    return {name: {k: v / n for k, v in counters.items()} for name, counters in usage.items()}
+
+
 def run_program(parameters, queues_in_, input_type_, retrying=True):
-    from image_patch import ImagePatch, llm_query, best_image_match, distance, bool_to_yesno
+    from image_patch import ImagePatch, llm_query, best_image_match, compute_depths, distance, bool_to_yesno
     from video_segment import VideoSegment
 
     global queue_results
 
     code, sample_id, image, annotation, possible_answers, query = parameters
 
-    code_header = f'def execute_command_{sample_id}(' \
-                  f'{input_type_}, annotation, possible_answers, query, ' \
-                  f'ImagePatch, VideoSegment, ' \
-                  'llm_query, bool_to_yesno, distance, best_image_match):\n' \
-                  f'    # Answer is:'
-
-    code = code.replace('```', '').replace('python', '')
-    code = code_header + code.strip()
+    code = program_code(code, sample_id, input_type_)
 
     # print(code)
 
@@ -79,14 +122,17 @@ def run_program(parameters, queues_in_, input_type_, retrying=True):
     video_segment_partial = partial(VideoSegment, queues=queues)
     llm_query_partial = partial(llm_query, queues=queues)
 
+    start_time = time.perf_counter()
     try:
-        answer, reason, info = globals()[f'execute_command_{sample_id}'](
-            # Inputs to the function
-            image, annotation, possible_answers, query,
-            # Classes to be used
-            image_patch_partial, video_segment_partial,
-            # Functions to be used
-            llm_query_partial, bool_to_yesno, distance, best_image_match)
+        # Language model usage of the sample, and duration of the calls to the API methods
+        with metering() as usage, timing() as timings:
+            answer, reason, info = globals()[f'execute_command_{sample_id}'](
+                # Inputs to the function
+                image, annotation, possible_answers, query,
+                # Classes to be used
+                image_patch_partial, video_segment_partial,
+                # Functions to be used
+                llm_query_partial, bool_to_yesno, distance, best_image_match, compute_depths)
     except Exception as e:
         # print full traceback
         traceback.print_exc()
@@ -111,6 +157,8 @@ def run_program(parameters, queues_in_, input_type_, retrying=True):
         'info': info,
         'code': code,
         'reason': reason,
+        'llm_usage': {name: dict(counters) for name, counters in usage.items()},
+        'timings': {'execute_command': [time.perf_counter() - start_time], **timings},
     }
 
 
@@ -121,7 +169,7 @@ def worker_init(queue_results_):
 
 
 def main():
-    mp.set_start_method('spawn')
+    mp.set_start_method('spawn', force=True)  # bench.py sets it before loading the models
 
     from vision_processes import queues_in, finish_all_consumers, forward, manager
     from datasets import get_dataset
@@ -169,6 +217,11 @@ def main():
     all_reasons = []
     all_reflection = []
     all_tropes = []
+    all_from_cache = []
+    all_llm_tokens = []
+    all_llm_costs = []
+    all_timings = defaultdict(list)  # API method -> durations of its calls
+    run_usage = defaultdict(Counter)  # Language model usage of the run, per process
 
     all_groundtruths = []
     all_ids = []
@@ -179,39 +232,74 @@ def main():
 
     filename = None
 
+    regenerator = ThreadPoolExecutor(max_workers=1)
+
     with mp.Pool(processes=num_processes, initializer=worker_init, initargs=(queues_results,)) \
             if config.multiprocessing else open(os.devnull, "w") as pool:
         try:
             n_batches = len(dataloader)
 
             for i, batch in tqdm(enumerate(dataloader), total=n_batches):
+                if over_budget(total_usage(run_usage)):
+                    console.print(f'The language model budget of the run is exhausted '
+                                  f'({format_dict(dict(total_usage(run_usage)))}). Not admitting new samples')
+                    break
 
                 # Combine all queries and get Codex predictions for them
                 # TODO compute Codex for next batch as current batch is being processed
 
+                invalid = []
+                regeneration = None
+                codex_usage = {}
                 if not config.use_cached_codex:
-                    codes, messages = codex(prompt=batch['query'], input_type=input_type, extra_context=batch['extra_context'])
+                    with metering() as codex_usage:
+                        codes, messages, from_cache = codex(prompt=batch['query'], input_type=input_type,
+                                                            extra_context=batch['extra_context'],
+                                                            return_cache_info=True)
+                    # The code that does not compile is requested again while the valid code runs
+                    invalid = [j for j, (c, sample_id) in enumerate(zip(codes, batch['sample_id']))
+                               if compilation_error(c, sample_id, input_type)]
+                    if len(invalid) > 0 and config.codex.max_regenerations > 0:
+                        regeneration = regenerator.submit(regenerate, codex, codes, invalid, batch, input_type)
                 else:
                     # codes = codes_all[i * batch_size:(i + 1) * batch_size]  # If cache
                     codes = [codes_all[trope] for trope in batch['trope']]
+                    from_cache = [None] * len(codes)  # Not generated in this run
 
-                # Run the code
-                if config.execute_code:
+                def execute(indices):
                     if not config.multiprocessing:
                         # Otherwise, we would create a new model for every process
-                        results = []
-                        for c, sample_id, img, anno, possible_answers, query, gt in \
-                                zip(codes, batch['sample_id'], batch['image'], batch['annotation'], batch['possible_answers'], batch['query'], batch['answer']):
-                            result = run_program([c, sample_id, img, anno, possible_answers, query], queues_in, input_type)
-                            result['groundtruth'] = gt
+                        results_ = []
+                        for j in indices:
+                            result = run_program([codes[j], batch['sample_id'][j], batch['image'][j],
+                                                  batch['annotation'][j], batch['possible_answers'][j],
+                                                  batch['query'][j]], queues_in, input_type)
+                            result['groundtruth'] = batch['answer'][j]
                             # reflection_result = reflection(c, msg, result)
                             # reflection_result = forward('reflection', c, msg, result)
                             # result['reflection_result'] = reflection_result
-                            results.append(result)
-                    else:
-                        results = list(pool.imap(partial(
-                            run_program, queues_in_=queues_in, input_type_=input_type),
-                            zip(codes, batch['sample_id'], batch['image'], batch['annotation'], batch['possible_answers'], batch['query'])))
+                            results_.append(result)
+                        return results_
+                    return list(pool.imap(partial(
+                        run_program, queues_in_=queues_in, input_type_=input_type),
+                        [(codes[j], batch['sample_id'][j], batch['image'][j], batch['annotation'][j],
+                          batch['possible_answers'][j], batch['query'][j]) for j in indices]))
+
+                # Run the code
+                results = [None] * len(codes)
+                if config.execute_code:
+                    valid = [j for j in range(len(codes)) if j not in invalid]
+                    for j, result in zip(valid, execute(valid)):
+                        results[j] = result
+                regeneration_usage = {}
+                if regeneration is not None:
+                    regenerated, regeneration_usage = regeneration.result()
+                    for j, c in zip(invalid, regenerated):
+                        codes[j] = c
+                        from_cache[j] = False
+                if config.execute_code:
+                    for j, result in zip(invalid, execute(invalid)):
+                        results[j] = result
                 else:
                     results = [{'code': c} for c in codes]
                     warnings.warn("Not executing code! This is only generating the code. We set the flag "
@@ -219,9 +307,25 @@ def main():
                                   "model can be dangerous. Set the flag 'execute_code' to True if you want to execute "
                                   "it.")
 
+                # Language model usage of every sample: its program, and its share of the code generation
+                samples_usage = [defaultdict(Counter) for _ in codes]
+                for j, r in enumerate(results):
+                    merge_usage(samples_usage[j], r.get('llm_usage', {}))
+                    merge_usage(samples_usage[j], split_usage(codex_usage, len(codes)))
+                    if j in invalid:
+                        merge_usage(samples_usage[j], split_usage(regeneration_usage, len(invalid)))
+                    merge_usage(run_usage, samples_usage[j])
+                samples_usage = [total_usage(u) for u in samples_usage]
+                all_llm_tokens += [u['prompt_tokens'] + u['completion_tokens'] for u in samples_usage]
+                all_llm_costs += [u['cost_usd'] for u in samples_usage]
+                for r in results:
+                    for name, seconds in r.get('timings', {}).items():
+                        all_timings[name] += seconds
+
                 all_answers += [r.get('answer', 'NO EXECUTION') for r in results]
                 all_infos += [json.dumps(r.get('info', {}), indent=2) for r in results]
                 all_codes += [r['code'] for r in results]
+                all_from_cache += from_cache
                 all_compilation_errors += [r.get('compilation_error', 'NO EXECUTION') for r in results]
                 all_runtime_errors += [r.get('runtime_error', 'NO EXECUTION') for r in results]
                 all_reasons += [r.get('reason', 'NO EXECUTION') for r in results]
@@ -263,11 +367,14 @@ def main():
                                     all_img_paths,
                                     all_possible_answers,
                                     all_codes,
+                                    all_from_cache,
                                     all_infos,
                                     all_reasons,
                                     #    all_reflection,
                                     all_compilation_errors,
-                                    all_runtime_errors]).T
+                                    all_runtime_errors,
+                                    all_llm_tokens,
+                                    all_llm_costs]).T
                     df.columns = [
                         'answer', 
                         'groundtruth', 
@@ -277,11 +384,14 @@ def main():
                         'img_path', 
                         'possible_answers', 
                         'code', 
+                        'code_from_cache',
                         'info', 
                         'reason', 
                         # 'reflection',
                         'compilation_error', 
-                        'runtime_error'
+                        'runtime_error',
+                        'llm_tokens',
+                        'llm_cost_usd',
                         ]
                     # make the result column a string
                     df.to_csv(results_dir / filename, header=True, index=False, encoding='utf-8', sep='|')
@@ -292,6 +402,7 @@ def main():
             console.print(f'Exception: {e}')
             console.print("Completing logging and exiting...")
 
+    console.print(f'Language model usage: {format_dict(dict(total_usage(run_usage)))}')
     try:
         accuracy = dataset.accuracy(all_answers, all_groundtruths, all_possible_answers, all_query_types)
         console.print(f'Final accuracy: {accuracy}')
@@ -320,11 +431,14 @@ def main():
                            all_img_paths,
                            all_possible_answers,
                            all_codes,
+                           all_from_cache,
                            all_infos,
                            all_reasons,
                         #    all_reflection,
                            all_compilation_errors,
-                           all_runtime_errors]).T
+                           all_runtime_errors,
+                           all_llm_tokens,
+                           all_llm_costs]).T
         df.columns = [
             'answer', 
             'groundtruth', 
@@ -334,21 +448,27 @@ def main():
             'img_path', 
             'possible_answers', 
             'code', 
+            'code_from_cache',
             'info', 
             'reason', 
             # 'reflection',
             'compilation_error', 
-            'runtime_error'
+            'runtime_error',
+            'llm_tokens',
+            'llm_cost_usd',
             ]
         # make the result column a string
         df.to_csv(results_dir / filename, header=True, index=False, encoding='utf-8', sep='|')
+        with open(results_dir / f'{pathlib.Path(filename).stem}_llm_usage.json', 'w') as f:
+            json.dump({'total': total_usage(run_usage), 'processes': run_usage}, f, indent=2)
         # torch.save([all_results, all_answers, all_codes, all_ids, all_queries, all_img_paths], results_dir/filename)
 
         if config.wandb:
-            wandb.log({'accuracy': accuracy})
+            wandb.log({'accuracy': accuracy, 'llm_cost_usd': total_usage(run_usage)['cost_usd']})
             wandb.log({'results': wandb.Table(dataframe=df, allow_mixed_types=True)})
 
     finish_all_consumers()
+    return {'num_samples': len(all_ids), 'timings': dict(all_timings), 'llm_usage': total_usage(run_usage)}
 
 
 if __name__ == '__main__':
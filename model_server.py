@@ -0,0 +1,84 @@
+"""
+Runs the models of vision_processes as a long-lived server, so that many runs of main_batch.py (or notebooks using
+main_simple_lib) reuse the same loaded models instead of loading them every time. Runs attach to the server when
+config.model_server.address is set, and call the models with the usual forward(model_name, ...).
+
+Usage:
+    CONFIG_NAMES=... python model_server.py            # Serve the models in config.load_models
+    CONFIG_NAMES=... python model_server.py --health   # Print the status of a running server
+
+Stop the server with Ctrl+C or SIGTERM: it stops accepting new requests, finishes the queued ones and exits.
+"""
+
+import argparse
+import signal
+import time
+
+import torch.multiprocessing as mp
+from rich.console import Console
+
+from configs import config
+
+console = Console(highlight=False)
+
+
+def serve():
+    config.model_server.serve = True
+    from vision_processes import manager, queues_in, consumers, request_stats, model_stats, finish_all_consumers, \
+        coalesced_requests
+
+    state = manager.get_state()
+    start_time = time.time()
+    console.print(f'Serving {list(queues_in.keys())} at {config.model_server.address}')
+
+    stop_signals = []
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_signals.append(signum))
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signals.append(signum))
+
+    while len(stop_signals) == 0:
+        state.update({
+            'uptime': time.time() - start_time,
+            'consumers_alive': {name: consumer.is_alive() for name, consumer in consumers.items()},
+            'queued_requests': {name: q.qsize() for name, q in queues_in.items()},
+            'coalesced_requests': coalesced_requests(request_stats),
+            'model_stats': dict(model_stats),
+        })
+        time.sleep(config.model_server.health_interval)
+
+    # Drain: clients see the state and stop sending requests, and the queued requests are finished
+    console.print('Draining the model server...')
+    state['state'] = 'draining'
+    deadline = time.time() + config.model_server.drain_timeout
+    while any(q.qsize() > 0 for q in queues_in.values()) and time.time() < deadline:
+        time.sleep(0.5)
+    finish_all_consumers()
+    state['state'] = 'stopped'
+    manager.shutdown()
+    console.print('Model server stopped')
+
+
+def print_health():
+    try:
+        from vision_processes import health
+        status = health()
+    except (OSError, RuntimeError) as e:  # Not running, or not accepting requests
+        console.print(f'Model server at {config.model_server.address} is not available: {e}')
+        return False
+    console.print(status)
+    return status.get('state') == 'serving' and all(status.get('consumers_alive', {}).values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Standalone server for the models in vision_processes')
+    parser.add_argument('--health', action='store_true', help='Print the status of a running server and exit')
+    args = parser.parse_args()
+
+    assert config.model_server.address, 'Set config.model_server.address (host:port or unix socket path)'
+    mp.set_start_method('spawn')
+    if args.health:
+        exit(0 if print_health() else 1)
+    serve()
+
+
+if __name__ == '__main__':
+    main()
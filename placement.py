@@ -0,0 +1,175 @@
+"""
+Assignment of the model consumers (and their replicas) to GPUs. Every model has a GPU memory footprint and a load (the
+time it spent computing in previous runs). Models are placed so that they fit in memory and the load is balanced.
+Footprints and loads are measured by the consumers when config.placement.measurements_dir is set, and otherwise taken
+from config.placement.footprints_gb.
+
+The planner does not need GPUs: with config.placement.devices_gb the plan can be computed (and checked) on a CPU-only
+machine. To print the plan for the current config:
+    CONFIG_NAMES=... python placement.py
+"""
+
+import fcntl
+import inspect
+import json
+import os
+
+from configs import config
+
+
+class PlacementError(Exception):
+    pass
+
+
+def plan_placement(footprints: dict, devices: list, loads: dict = None, replicas: dict = None) -> dict:
+    """
+    Returns, for every model, the list of devices (indices into `devices`) where its replicas go.
+    Parameters
+    ----------
+    footprints : dict
+        GPU memory (in GB) needed by one replica of every model.
+    devices : list
+        Memory (in GB) available in every device.
+    loads : dict
+        Relative load of every model (e.g. seconds spent computing). Defaults to 1. It is split among the replicas.
+    replicas : dict
+        Number of replicas of every model. Defaults to 1.
+    """
+    loads = {} if loads is None else loads
+    replicas = {} if replicas is None else replicas
+    free = list(devices)
+    device_load = [0.] * len(devices)
+    plan = {}
+    # Largest models first, so that they still find a device with enough memory
+    for name in sorted(footprints, key=lambda n: (-footprints[n], n)):
+        num_replicas = replicas.get(name, 1)
+        plan[name] = []
+        for _ in range(num_replicas):
+            candidates = [d for d in range(len(devices)) if free[d] >= footprints[name]]
+            if len(candidates) == 0:
+                raise PlacementError(f'Not enough GPU memory for {name} ({footprints[name]:.1f}GB). '
+                                     f'Free memory per device: {[round(f, 1) for f in free]}GB')
+            # Replicas of the same model go to different devices if possible, then the least loaded device
+            device = min(candidates, key=lambda d: (d in plan[name], device_load[d], -free[d], d))
+            free[device] -= footprints[name]
+            device_load[device] += loads.get(name, 1.) / num_replicas
+            plan[name].append(device)
+    return plan
+
+
+def available_devices() -> list:
+    """Memory (in GB) that can be planned in every device. From config.placement.devices_gb if given (dry run),
+    otherwise from the visible GPUs"""
+    if config.placement.devices_gb:
+        return list(config.placement.devices_gb)
+    import torch
+    return [torch.cuda.get_device_properties(i).total_memory / 2 ** 30 * config.placement.memory_fraction
+            for i in range(torch.cuda.device_count())]
+
+
+def measurement_path(process_name):
+    return os.path.join(config.placement.measurements_dir, f'{process_name}.json')
+
+
+def load_measurement(process_name) -> dict:
+    if not config.placement.measurements_dir or not os.path.exists(measurement_path(process_name)):
+        return {}
+    with open(measurement_path(process_name)) as f:
+        return json.load(f)
+
+
+def record_measurement(process_name, **values):
+    """Stores measured values (footprint_gb, busy_seconds, calls) of a model, for the planner of later runs"""
+    if not config.placement.measurements_dir:
+        return
+    os.makedirs(config.placement.measurements_dir, exist_ok=True)
+    path = measurement_path(process_name)
+    # The replicas of a model update the same file: the update is done under a lock, and the file is replaced at once,
+    # so that readers never see it partially written
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        measurement = load_measurement(process_name)
+        measurement.update(values)
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(measurement, f)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def cache_gb(process_name):
+    """GPU memory that the caches of a model (e.g. features of recent images) can take, on top of its weights"""
+    cache_mb = {'glip': config.glip.visual_cache_mb, 'blip': config.blip_image_cache_mb}.get(process_name, 0)
+    return cache_mb / 1024
+
+
+def footprint_gb(process_name, default=None):
+    """Measured footprint of the weights if available, otherwise the declared one (or default), plus the memory of the
+    caches of the model. None if unknown"""
+    footprint = load_measurement(process_name).get('footprint_gb', None)
+    if footprint is None:
+        footprint = config.placement.footprints_gb.get(process_name, default)
+    if footprint is None:
+        return None
+    return footprint + cache_gb(process_name)
+
+
+def plan_processes(process_names: list, replicas: dict = None) -> dict:
+    """
+    Plans the placement of the given (GPU) processes, using their footprints, loads and replicas (by default
+    config.placement.replicas). Models with an unknown footprint are assumed to take config.placement.default_footprint_gb.
+    """
+    footprints = {name: footprint_gb(name, config.placement.default_footprint_gb) for name in process_names}
+    loads = {name: load_measurement(name).get('busy_seconds', 1.) for name in process_names}
+    replicas = config.placement.replicas if replicas is None else replicas
+    return plan_placement(footprints, available_devices(), loads, replicas)
+
+
+def model_classes() -> list:
+    """Classes of the models that vision_processes loads (their simulation for the ones in config.simulation.models),
+    sorted by load_order"""
+    import vision_models
+    list_models = [m[1] for m in inspect.getmembers(vision_models, inspect.isclass)
+                   if issubclass(m[1], vision_models.BaseModel) and m[1] != vision_models.BaseModel]
+    if config.simulation.models:
+        import simulated_models
+        list_models = simulated_models.substitute(list_models)
+    list_models.sort(key=lambda x: x.load_order)
+    return list_models
+
+
+def plan_models(list_models: list, multiprocessing: bool):
+    """
+    Device of every replica of the enabled models (process_name -> list of GPU numbers). Models that do not require a
+    GPU get None. Returns None if there is nothing to plan (placement disabled or no GPUs)
+    """
+    process_names = [(model_class, process_name) for model_class in list_models
+                     for process_name in model_class.list_processes()
+                     if process_name in config.load_models and config.load_models[process_name]]
+    if not config.placement.enabled or not available_devices():
+        return None
+    # Without multiprocessing there is one replica of every model
+    replicas = config.placement.replicas if multiprocessing else {}
+    plan = plan_processes([process_name for model_class, process_name in process_names if model_class.requires_gpu],
+                          replicas)
+    for model_class, process_name in process_names:
+        if process_name not in plan:
+            plan[process_name] = [None] * replicas.get(process_name, 1)
+    return plan
+
+
+def main():
+    # Dry run: the same plan that vision_processes computes, with the declared devices if given (no GPU needed)
+    plan = plan_models(model_classes(), config.multiprocessing)
+    if plan is None:
+        print('Nothing to plan: set placement.enabled, and placement.devices_gb if there are no visible GPUs')
+        return
+    for device, memory in enumerate(available_devices()):
+        names = [f'{name} ({footprint_gb(name, config.placement.default_footprint_gb):.1f}GB)'
+                 for name, ds in plan.items() for d in ds if d == device]
+        print(f'GPU {device} ({memory:.1f}GB): {", ".join(names)}')
+    cpu_names = [name for name, ds in plan.items() if None in ds]
+    if len(cpu_names) > 0:
+        print(f'Default device of their class (no GPU required): {", ".join(cpu_names)}')
+
+
+if __name__ == '__main__':
+    main()
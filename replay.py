@@ -0,0 +1,115 @@
+"""
+Record and replay of the requests to the models, to iterate on prompts and program logic without GPUs or API keys.
+With config.record_replay.mode = 'record', every request sent with vision_processes.forward (model name and inputs)
+is stored with its output. With mode = 'replay', no model is loaded, and the requests are served from the store.
+Requests that are not in the store are not computed: they raise ReplayMiss (so the sample fails with a runtime error)
+and are reported at the end of the run.
+
+The store is a directory with an append-only pickle file per process (so that the workers do not share files).
+Requests are identified by a content hash of their inputs. Inputs are also stored in readable form if they are short
+(config.record_replay.max_arg_chars), to know what the missing requests were.
+"""
+
+import glob
+import json
+import os
+import pickle
+import threading
+from collections import Counter
+
+from configs import config
+from utils import hash_inputs
+
+
+class ReplayMiss(KeyError):
+    pass
+
+
+def describe(x):
+    """Short readable form of an input: its repr if it is short, otherwise its type and content hash"""
+    text = repr(x)
+    if len(text) <= config.record_replay.max_arg_chars:
+        return text
+    try:
+        return f'<{type(x).__name__} {hash_inputs(x)[:12]}>'
+    except Exception:
+        return f'<{type(x).__name__}>'
+
+
+class RequestStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.recorded = set()  # Keys written by this process
+        self.outputs = None  # Key -> output, loaded on the first replayed request
+
+    @staticmethod
+    def key(model_name, args, kwargs):
+        return hash_inputs((model_name, args, kwargs))
+
+    @staticmethod
+    def describe_request(model_name, args, kwargs):
+        return {'model': model_name, 'args': [describe(a) for a in args],
+                'kwargs': {k: describe(v) for k, v in kwargs.items()}}
+
+    def record(self, model_name, args, kwargs, out):
+        try:
+            key = self.key(model_name, args, kwargs)
+        except Exception:  # Inputs that cannot be hashed cannot be replayed either
+            return
+        with self.lock:
+            if key in self.recorded:
+                return
+            self.recorded.add(key)
+            if self.file is None:
+                os.makedirs(self.path, exist_ok=True)
+                self.file = open(os.path.join(self.path, f'requests_{os.getpid()}.pkl'), 'ab')
+            pickle.dump({'key': key, **self.describe_request(model_name, args, kwargs), 'out': out}, self.file)
+            self.file.flush()
+
+    def load(self):
+        outputs = {}
+        for filename in sorted(glob.glob(os.path.join(self.path, 'requests_*.pkl'))):
+            with open(filename, 'rb') as f:
+                while True:
+                    try:
+                        entry = pickle.load(f)
+                    except EOFError:
+                        break
+                    except pickle.UnpicklingError:  # Last request of a process that was interrupted while writing
+                        break
+                    outputs[entry['key']] = entry['out']
+        return outputs
+
+    def replay(self, model_name, args, kwargs):
+        with self.lock:
+            if self.outputs is None:
+                self.outputs = self.load()
+        try:
+            key = self.key(model_name, args, kwargs)
+        except Exception:
+            key = None
+        if key in self.outputs:
+            return self.outputs[key]
+        request = self.describe_request(model_name, args, kwargs)
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, f'misses_{os.getpid()}.jsonl'), 'a') as f:
+                f.write(json.dumps(request) + '\n')
+        raise ReplayMiss(f'Request not in the store at {self.path}: {request}')
+
+
+def clear_misses(path):
+    for filename in glob.glob(os.path.join(path, 'misses_*.jsonl')):
+        os.remove(filename)
+
+
+def report_misses(path) -> Counter:
+    """Number of missed requests per model, from all the processes of the run"""
+    misses = Counter()
+    for filename in glob.glob(os.path.join(path, 'misses_*.jsonl')):
+        with open(filename) as f:
+            for line in f:
+                misses[json.loads(line)['model']] += 1
+    return misses
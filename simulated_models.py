@@ -0,0 +1,206 @@
+"""
+Simulated models, to test the performance of the dispatch (vision_processes) and execution (main_batch) of the programs
+without checkpoints, GPUs or API keys. They have the same names, forward signatures and batching attributes as the
+models they replace, and take the time given by config.simulation.latency: a distribution (constant, normal,
+lognormal or exponential) with the given mean and std, for one input, times batch_size ** batch_exponent for batched
+calls (0: batching is free, 1: no gain from batching). The outputs have the same types and shapes as the real ones,
+and are deterministic given the inputs, so that coalescing and record/replay behave as with the real models.
+
+The models in config.simulation.models (e.g. [glip, blip, deepface, gpt3, codex]) are replaced by their simulation.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+import torch
+
+from configs import config
+from llm_client import LLMClient
+from vision_models import BaseModel, count_tokens
+
+words = ['person', 'car', 'dog', 'table', 'standing', 'talking', 'smiling', 'red', 'outside', 'room', 'night', 'yes',
+         'no', 'two', 'man', 'woman', 'walking', 'holding', 'phone', 'window']
+
+
+class SimulatedModel(BaseModel):
+    """Sleeps for the simulated latency. Outputs are drawn from a random generator seeded with the inputs"""
+
+    def __init__(self, gpu_number=0):
+        super().__init__(gpu_number=gpu_number)
+        self.random = random.Random(config.simulation.seed)  # For the latencies
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def simulate_latency(self, batch_size=1, process_name=None):
+        latency = config.simulation.latency
+        latency_config = latency[process_name] if process_name is not None and process_name in latency \
+            else latency[self.name]
+        mean, std = latency_config.mean, latency_config.get('std', 0.)
+        distribution = latency_config.get('distribution', 'lognormal')
+        with self.lock:
+            if distribution == 'constant' or std == 0:
+                latency = mean
+            elif distribution == 'normal':
+                latency = max(0., self.random.gauss(mean, std))
+            elif distribution == 'lognormal':
+                sigma = math.sqrt(math.log(1 + (std / mean) ** 2))
+                latency = self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+            elif distribution == 'exponential':
+                latency = self.random.expovariate(1 / mean)
+            else:
+                raise ValueError(f'Unknown latency distribution {distribution}')
+            latency *= batch_size ** latency_config.get('batch_exponent', 1.)
+            self.counters['calls'] += 1
+            self.counters['inputs'] += batch_size
+            self.counters['simulated_seconds'] += latency
+        time.sleep(latency)
+
+    @staticmethod
+    def output_random(*inputs):
+        """Random generator for the output of the given inputs (descriptions of them: strings, shapes)"""
+        return random.Random(f'{config.simulation.seed}-{inputs}')
+
+    @staticmethod
+    def sentence(rng, num_words):
+        return ' '.join(rng.choice(words) for _ in range(num_words))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class SimulatedGLIP(SimulatedModel):
+    name = 'glip'
+
+    def forward(self, image: torch.Tensor, obj, return_labels=False, confidence_threshold=None):
+        self.simulate_latency()
+        height, width = image.shape[-2:]
+        rng = self.output_random(obj, tuple(image.shape))
+        boxes = []
+        for _ in range(rng.randint(0, config.simulation.outputs.max_boxes)):
+            left, right = sorted(rng.randint(0, width - 1) for _ in range(2))
+            lower, upper = sorted(rng.randint(0, height - 1) for _ in range(2))
+            boxes.append([left, lower, right + 1, upper + 1])
+        bboxes = torch.tensor(boxes, dtype=torch.long).view(-1, 4)  # [left, lower, right, upper]
+        if return_labels:
+            return bboxes, torch.zeros(len(bboxes), dtype=torch.long).numpy()
+        return bboxes
+
+
+class SimulatedBLIP(SimulatedModel):
+    name = 'blip'
+    to_batch = True
+    max_batch_size = 32
+    seconds_collect_data = 0.2
+
+    def forward(self, image, question=None, task='caption'):
+        if not self.to_batch:
+            image, question, task = [image], [question], [task]
+        self.simulate_latency(batch_size=len(image))
+        response = []
+        for im, q, t in zip(image, question, task):
+            rng = self.output_random(q, t, tuple(im.shape))
+            if t == 'yesno':
+                response.append(rng.choice(['yes', 'no']))
+            elif t == 'caption':
+                response.append(self.sentence(rng, config.simulation.outputs.caption_words))
+            else:
+                response.append(self.sentence(rng, config.simulation.outputs.answer_words))
+        if not self.to_batch:
+            response = response[0]
+        return response
+
+
+class SimulatedDeepFace(SimulatedModel):
+    name = 'deepface'
+
+    def forward(self, image, role_face_db: dict):
+        self.simulate_latency()
+        rng = self.output_random(tuple(image.cropped_image.shape), image.left, image.lower, len(role_face_db))
+        if rng.random() < config.simulation.outputs.no_face_probability:
+            return None, role_face_db
+        embedding = [rng.random() for _ in range(8)]
+        if len(role_face_db) > 0 and rng.random() < config.simulation.outputs.known_face_probability:
+            pid = rng.choice(sorted(role_face_db))
+            role_face_db[pid].append(embedding)
+        else:
+            pid = f'{rng.getrandbits(64):016x}'
+            role_face_db[pid] = [embedding]
+        return pid, role_face_db
+
+
+class SimulatedGPT3(SimulatedModel):
+    name = 'gpt3'
+    requires_gpu = False
+
+    def __init__(self, gpu_number=0):
+        super().__init__(gpu_number=gpu_number)
+        self.client = LLMClient(self.name)  # Only to exercise the usage accounting
+
+    @classmethod
+    def list_processes(cls):
+        return ['gpt3_' + n for n in ['qa', 'guess', 'general', 'summarize']]
+
+    def forward(self, prompt, process_name, to_json=False, to_yesno=False):
+        start_time = time.time()
+        self.simulate_latency(process_name=process_name)
+        prompt = str(prompt)
+        rng = self.output_random(process_name, prompt, to_json, to_yesno)
+        if process_name == 'gpt3_summarize':
+            # Summaries are shorter than the text, so that select_answer converges
+            response = prompt[:config.simulation.outputs.summary_chars]
+        elif to_json:
+            response = json.dumps({'answer': rng.choice(['yes', 'no']),
+                                   'reason': self.sentence(rng, config.simulation.outputs.answer_words)})
+        elif to_yesno:
+            response = rng.choice(['yes', 'no'])
+        else:
+            response = self.sentence(rng, config.simulation.outputs.answer_words)
+        self.client.record_usage('simulated', count_tokens(prompt), count_tokens(response), time.time() - start_time)
+        return response
+
+    def stats(self):
+        return {**super().stats(), **self.client.stats()}
+
+
+class SimulatedCodex(SimulatedModel):
+    """Returns programs from a results file (config.simulation.outputs.programs), by query if it is there"""
+    name = 'codex'
+    requires_gpu = False
+
+    def __init__(self, gpu_number=0):
+        super().__init__(gpu_number=gpu_number)
+        import pandas as pd
+        programs = pd.read_csv(config.simulation.outputs.programs, sep='|')
+        self.programs = dict(zip(programs['query'], programs['code']))
+        self.program_list = list(programs['code'])
+
+    def forward(self, prompt, input_type='image', extra_context=None, temperature=None, return_cache_info=False):
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        self.simulate_latency(batch_size=len(prompts))
+        codes = [self.programs.get(p, None) or self.output_random(p, temperature).choice(self.program_list)
+                 for p in prompts]
+        messages = [[{'role': 'user', 'content': p}] for p in prompts]
+        from_cache = [False] * len(prompts)
+        if not isinstance(prompt, list):
+            codes, messages, from_cache = codes[0], messages[0], from_cache[0]
+        if return_cache_info:
+            return codes, messages, from_cache
+        return codes, messages
+
+
+simulated_models = [SimulatedGLIP, SimulatedBLIP, SimulatedDeepFace, SimulatedGPT3, SimulatedCodex]
+
+
+def substitute(models: list) -> list:
+    """Replaces the model classes in config.simulation.models by their simulation"""
+    simulations = {model_class.name: model_class for model_class in simulated_models
+                   if model_class.name in config.simulation.models}
+    unknown = set(config.simulation.models) - set(simulations)
+    if len(unknown) > 0:
+        raise ValueError(f'No simulation for {sorted(unknown)}. Simulated models: {[m.name for m in simulated_models]}')
+    return [simulations.get(model_class.name, model_class) for model_class in models]
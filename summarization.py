@@ -0,0 +1,59 @@
+"""
+Splitting of the information of a video into chunks for the summarization in VideoSegment.select_answer (map), and
+summarization of the summaries until they are short enough (reduce). The summarization itself is passed in, so that
+these functions do not depend on the models.
+"""
+
+import json
+
+
+def chunk_info(info: dict, chunk_chars: int) -> list[str]:
+    """
+    Splits info into json strings of about chunk_chars characters (a chunk ends with the item that makes it longer
+    than chunk_chars). The length of every chunk is accounted incrementally, without serializing it again.
+    """
+    chunks = []
+    items = []
+    length = 2  # "{}"
+    for key, value in info.items():
+        item = json.dumps({key: value})[1:-1]
+        length += len(item) + (2 if len(items) > 0 else 0)  # ", " separator
+        items.append(item)
+        if length > chunk_chars:
+            chunks.append('{' + ', '.join(items) + '}')
+            items = []
+            length = 2
+    if len(items) > 0:
+        chunks.append('{' + ', '.join(items) + '}')
+    return chunks
+
+
+def chunk_texts(texts: list[str], chunk_chars: int) -> list[str]:
+    """Groups consecutive texts into chunks of at most chunk_chars characters, splitting the texts that are longer"""
+    chunks = []
+    current = ''
+    for text in texts:
+        for start in range(0, max(len(text), 1), chunk_chars - 1):
+            piece = '\n' + text[start:start + chunk_chars - 1]
+            if len(current) + len(piece) > chunk_chars and current:
+                chunks.append(current)
+                current = ''
+            current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def reduce_summaries(summaries: list[str], summarize, character_limit: int, chunk_chars: int) -> str:
+    """
+    Joins the summaries. While the result is longer than character_limit, the summaries are summarized again in chunks
+    of chunk_chars characters with `summarize` (list of chunks -> list of summaries). Stops when they do not get shorter.
+    """
+    info = ''.join('\n' + summary for summary in summaries)
+    while len(info) > character_limit:
+        summaries = summarize(chunk_texts(summaries, chunk_chars))
+        reduced = ''.join('\n' + summary for summary in summaries)
+        if len(reduced) >= len(info):  # The summaries do not get shorter
+            break
+        info = reduced
+    return info
@@ -0,0 +1,54 @@
+"""
+Tests of the detection of a complete execute_command function in a streamed completion. Run from the root of the
+repository:
+    python -m pytest tests
+"""
+
+from completion import complete_function, defines_execute_command
+
+FUNCTION = 'def execute_command(video):\n    answer = video.select_answer({}, "question")\n    return answer'
+
+
+def test_fenced():
+    assert complete_function(f'```python\n{FUNCTION}\n') is None
+    assert complete_function(f'```python\n{FUNCTION}\n```').strip() == FUNCTION
+    assert complete_function(f'Here is the code:\n```python\n{FUNCTION}\n```\nIt selects').strip() == FUNCTION
+
+
+def test_unfenced():
+    assert complete_function(f'{FUNCTION}\n') is None
+    assert complete_function(f'{FUNCTION}\nexecute_command(video)\n') == FUNCTION
+    # The last line may be incomplete
+    assert complete_function(f'{FUNCTION}\nexecu') is None
+
+
+def test_comment():
+    assert complete_function(f'{FUNCTION}\n# The answer is returned\n') is None
+    assert complete_function(f'{FUNCTION}\n# The answer is returned\nexecute_command(video)\n') == FUNCTION
+
+
+def test_open_string():
+    function = 'def execute_command(video):\n    prompt = """\nWhat happens in the video?\n"""\n    return prompt'
+    assert complete_function(f'{function[:function.index("What")]}What happens in the video?\n"""\n') is None
+    assert complete_function(f'{function}\nexecute_command(video)\n') == function
+
+
+def test_open_bracket():
+    function = 'def execute_command(video):\n    options = [\n"a",\n"b",\n]\n    return options'
+    assert complete_function(f'{function[:function.index("]")]}') is None
+    assert complete_function(f'{function}\nexecute_command(video)\n') == function
+
+
+def test_trailing_prose():
+    assert complete_function(f'{FUNCTION}\nThis function asks the video for the answer.\n') == FUNCTION
+    # Prose before the function is not part of it
+    assert complete_function(f'The code:\n{FUNCTION}\nIt returns the answer.\n') == FUNCTION
+
+
+def test_defines_execute_command():
+    assert defines_execute_command(FUNCTION)
+    assert defines_execute_command(f'```python\n{FUNCTION}\n```')
+    assert not defines_execute_command('def other(video):\n    return 1')
+    assert not defines_execute_command('def execute_command(video):\n    return (')
+    # Only a top-level definition counts
+    assert not defines_execute_command('class A:\n    def execute_command(self):\n        return 1')
@@ -0,0 +1,102 @@
+"""
+Tests of the deadlines, hedging and usage accounting of LLMClient, with a fake model call that sleeps (no network).
+Run from the root of the repository:
+    python -m pytest tests
+"""
+
+import threading
+import time
+
+import pytest
+
+from configs import config
+from llm_client import DeadlineExceeded, LLMClient, metering
+
+
+class FakeModel:
+    """Returns the name of every request after sleeping its delay. One delay per request, in the order they are sent"""
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.lock = threading.Lock()
+
+    def __call__(self, prompt):
+        with self.lock:
+            delay = self.delays.pop(0)
+        time.sleep(delay)
+        return f'{prompt} after {delay}s'
+
+
+def usage_of(response):
+    return 'fake-model', 10, 5
+
+
+@pytest.fixture
+def client_config():
+    keys = ['deadline', 'hedge', 'hedge_quantile', 'min_samples']
+    saved = {key: config.llm_client[key] for key in keys}
+    config.llm_client.deadline = 5
+    config.llm_client.hedge = True
+    config.llm_client.hedge_quantile = 0.5
+    config.llm_client.min_samples = 3
+    yield config.llm_client
+    for key, value in saved.items():
+        config.llm_client[key] = value
+
+
+def hedging_client():
+    """Client that hedges requests slower than 0.05 seconds"""
+    client = LLMClient('fake')
+    client.latencies.extend([0.05] * config.llm_client.min_samples)
+    return client
+
+
+def test_hedged_call_returns_first_response(client_config):
+    client = hedging_client()
+    response = client.call(FakeModel(1., 0.01), 'question', usage_of=usage_of)
+    assert response == 'question after 0.01s'
+    assert client.counters['hedged'] == 1
+    assert client.counters['hedge_wins'] == 1
+
+
+def test_not_hedged_when_fast(client_config):
+    client = hedging_client()
+    assert client.call(FakeModel(0.01), 'question', usage_of=usage_of) == 'question after 0.01s'
+    assert client.counters['hedged'] == 0
+
+
+def test_deadline_exceeded(client_config):
+    client_config.deadline = 0.1
+    client = LLMClient('fake')  # Not enough latencies to hedge
+    start_time = time.time()
+    with pytest.raises(DeadlineExceeded):
+        client.call(FakeModel(1.), 'question', usage_of=usage_of)
+    assert time.time() - start_time < 0.5
+    assert client.counters['deadline_exceeded'] == 1
+
+
+def test_error_raised(client_config):
+    def fail(prompt):
+        raise ValueError(prompt)
+    client = LLMClient('fake')
+    with pytest.raises(ValueError):
+        client.call(fail, 'question', usage_of=usage_of)
+    assert client.counters['errors'] == 1
+
+
+def test_losing_hedge_usage_counted_once(client_config):
+    client = hedging_client()
+    with metering() as usage:
+        client.call(FakeModel(0.3, 0.01), 'question', usage_of=usage_of)
+    # Only the winner had finished when the call returned
+    assert usage['fake']['llm_calls'] == 1
+    time.sleep(0.5)  # The original request finishes, after the call returned
+    with metering() as next_usage:
+        client.call(FakeModel(0.01), 'question', usage_of=usage_of)
+    # The next call collects the usage of the abandoned request, and its own
+    assert next_usage['fake']['llm_calls'] == 2
+    assert next_usage['fake']['prompt_tokens'] == 20
+    assert client.usage['llm_calls'] == 3
+    with metering() as last_usage:
+        client.call(FakeModel(0.01), 'question', usage_of=usage_of)
+    assert last_usage['fake']['llm_calls'] == 1
@@ -0,0 +1,47 @@
+"""
+Tests of the GPU placement planner. Run from the root of the repository (the config files are read from there):
+    python -m pytest tests
+"""
+
+import pytest
+
+from placement import PlacementError, plan_placement
+
+
+def test_largest_models_first():
+    # glip only fits in the first device if it is placed before the smaller models fill it
+    plan = plan_placement({'glip': 8, 'depth': 2, 'clip': 2}, devices=[10, 4])
+    assert plan['glip'] == [0]
+    assert sorted(plan['depth'] + plan['clip']) == [0, 1]
+
+
+def test_fits_in_memory():
+    footprints = {'blip': 10, 'glip': 5, 'xvlm': 2, 'tcl': 2, 'depth': 2}
+    devices = [12, 12]
+    plan = plan_placement(footprints, devices)
+    for device, memory in enumerate(devices):
+        used = sum(footprints[name] for name, ds in plan.items() for d in ds if d == device)
+        assert used <= memory
+
+
+def test_balances_load():
+    plan = plan_placement({'a': 1, 'b': 1, 'c': 1}, devices=[10, 10], loads={'a': 10, 'b': 1, 'c': 1})
+    # The busiest model gets a device for itself
+    assert plan['b'] == plan['c'] != plan['a']
+
+
+def test_replicas_on_different_devices():
+    plan = plan_placement({'blip': 4}, devices=[10, 10, 10], replicas={'blip': 3})
+    assert sorted(plan['blip']) == [0, 1, 2]
+
+
+def test_replicas_share_device_if_needed():
+    plan = plan_placement({'blip': 4}, devices=[10], replicas={'blip': 2})
+    assert plan['blip'] == [0, 0]
+
+
+def test_not_enough_memory():
+    with pytest.raises(PlacementError):
+        plan_placement({'codellama': 15}, devices=[12, 12])
+    with pytest.raises(PlacementError):
+        plan_placement({'blip': 6}, devices=[10], replicas={'blip': 2})
@@ -0,0 +1,67 @@
+"""
+Tests of the chunking of the video information and of the reduce step of VideoSegment.select_answer. Run from the root
+of the repository:
+    python -m pytest tests
+"""
+
+import json
+
+from summarization import chunk_info, chunk_texts, reduce_summaries
+
+
+def test_chunk_info_within_budget():
+    info = {f'frame {i}': f'a person is walking {i}' * (i % 5 + 1) for i in range(100)}
+    chunks = chunk_info(info, chunk_chars=300)
+    assert len(chunks) > 1
+    merged = {}
+    for chunk in chunks:
+        items = json.loads(chunk)
+        # A chunk only goes over the budget with its last item
+        last_key = list(items)[-1]
+        assert len(json.dumps({k: v for k, v in items.items() if k != last_key})) <= 300
+        merged.update(items)
+    assert merged == info
+
+
+def test_chunk_info_oversized_record():
+    info = {'a': 'short', 'b': 'x' * 1000, 'c': 'short'}
+    chunks = chunk_info(info, chunk_chars=100)
+    assert [json.loads(chunk) for chunk in chunks] == [{'a': 'short', 'b': 'x' * 1000}, {'c': 'short'}]
+
+
+def test_chunk_texts_within_budget():
+    texts = [f'summary {i} ' * (i % 10 + 1) for i in range(30)]  # Shorter than a chunk: not split
+    chunks = chunk_texts(texts, chunk_chars=200)
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert ''.join(chunks) == ''.join('\n' + text for text in texts)
+
+
+def test_chunk_texts_oversized_text():
+    chunks = chunk_texts(['short', 'y' * 1000], chunk_chars=100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert ''.join(chunks).replace('\n', '') == 'short' + 'y' * 1000
+
+
+def test_reduce_summaries_short_enough():
+    calls = []
+    info = reduce_summaries(['one', 'two'], lambda chunks: calls.append(chunks) or chunks, 100, 50)
+    assert info == '\none\ntwo'
+    assert calls == []
+
+
+def test_reduce_summaries_shrinks():
+    def summarize(chunks):
+        return [chunk[:len(chunk) // 2] for chunk in chunks]
+    info = reduce_summaries(['z' * 100] * 10, summarize, character_limit=200, chunk_chars=150)
+    assert len(info) <= 200
+
+
+def test_reduce_summaries_stops_when_not_shorter():
+    calls = []
+
+    def summarize(chunks):
+        calls.append(chunks)
+        return [chunk + ' (not summarized)' for chunk in chunks]
+    info = reduce_summaries(['w' * 100] * 10, summarize, character_limit=200, chunk_chars=150)
+    assert len(calls) == 1
+    assert info == ''.join('\n' + 'w' * 100 for _ in range(10))
@@ -1,14 +1,20 @@
+import contextlib
+import functools
+import hashlib
 import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pandas as pd
 import pathlib
+import pickle
 import random
 import sys
+import threading
 import time
 import torch
 from PIL import Image
+from collections import OrderedDict, defaultdict
 from torchvision import transforms
 from torchvision.utils import draw_bounding_boxes as tv_draw_bounding_boxes
 from torchvision.utils import make_grid
@@ -171,6 +177,95 @@ def code_to_paste(code):
     print('\n'.join([c[4:] for c in code.split('\n')[1:]]).replace('image', 'ip').replace('return ', ''))
 
 
+def hash_tensor(x) -> str:
+    """Content hash of a tensor (or array), including its shape and dtype. Used as a cache key for images"""
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu().contiguous().numpy()
+    x = np.ascontiguousarray(x)
+    h = hashlib.sha1(x.tobytes())
+    h.update(f'{x.shape}{x.dtype}'.encode())
+    return h.hexdigest()
+
+
+def hash_inputs(x) -> str:
+    """Content hash of (possibly nested) model inputs. Tensors, arrays and images are hashed by their content"""
+    def normalize(v):
+        if isinstance(v, (torch.Tensor, np.ndarray)):
+            return 'tensor', hash_tensor(v)
+        if isinstance(v, Image.Image):
+            return 'image', hash_tensor(np.asarray(v)), v.mode
+        if isinstance(v, dict):
+            return 'dict', tuple((k, normalize(v_)) for k, v_ in v.items())
+        if isinstance(v, (list, tuple)):
+            return type(v).__name__, tuple(normalize(v_) for v_ in v)
+        return v
+    return hashlib.sha1(pickle.dumps(normalize(x))).hexdigest()
+
+
+def tensors_nbytes(x) -> int:
+    """Number of bytes taken by all the tensors in a (possibly nested) list, tuple or dict"""
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    if isinstance(x, dict):
+        return sum(tensors_nbytes(v) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        return sum(tensors_nbytes(v) for v in x)
+    return 0
+
+
+class LRUCache:
+    """
+    Simple least-recently-used cache. Entries are evicted when there are more than max_size of them, or, if max_bytes
+    is given, when the total size of the entries (as measured by sizeof) is over max_bytes.
+    """
+
+    def __init__(self, max_size=128, max_bytes=None, sizeof=tensors_nbytes):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        if (self.max_size is not None and self.max_size <= 0) or (self.max_bytes is not None and self.max_bytes <= 0):
+            return
+        if key in self.data:
+            self.pop(key)
+        self.data[key] = value
+        if self.max_bytes is not None:
+            self.sizes[key] = self.sizeof(value)
+            self.total_bytes += self.sizes[key]
+        while len(self.data) > 0 and ((self.max_size is not None and len(self.data) > self.max_size) or
+                                      (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            self.pop(next(iter(self.data)))
+
+    def pop(self, key, default=None):
+        self.total_bytes -= self.sizes.pop(key, 0)
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+        self.sizes.clear()
+        self.total_bytes = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+
 class HiddenPrints:
     hide_prints = False
 
@@ -207,3 +302,34 @@ class HiddenPrints:
                 self.console.print(f'{self.model_name} loaded ')
             import tqdm
             tqdm.tqdm = self.tqdm_aux
+
+
+_timings = threading.local()
+
+
+@contextlib.contextmanager
+def timing():
+    """Collects the durations (name -> list of seconds) of the calls to @timed functions made in this thread"""
+    previous = getattr(_timings, 'current', None)
+    _timings.current = defaultdict(list)
+    try:
+        yield _timings.current
+    finally:
+        _timings.current = previous
+
+
+def timed(name):
+    """Records the duration of the calls to the decorated function, inside timing() blocks"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings = getattr(_timings, 'current', None)
+            if timings is None:
+                return fn(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings[name].append(time.perf_counter() - start_time)
+        return wrapper
+    return decorator
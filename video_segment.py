@@ -5,10 +5,16 @@ from typing import Union, Iterator
 
 from configs import config
 from image_patch import ImagePatch
-from vision_processes import forward
+from summarization import chunk_info, reduce_summaries
+from vision_processes import forward, forward_many
 
+import hashlib
+import json
 import os
-from utils import show_single_image
+from utils import LRUCache, show_single_image, timed
+
+summary_cache = LRUCache(max_size=config.summarization.cache_size)  # Summaries of chunks of info in this process
+
 
 class VideoSegment:
     """A Python class containing a set of frames represented as ImagePatch objects, as well as relevant information.
@@ -77,6 +83,19 @@ class VideoSegment:
     def forward(self, model_name, *args, **kwargs):
         return forward(model_name, *args, queues=self.queues, **kwargs)
 
+    def summarize_chunks(self, chunks: list[str]) -> list[str]:
+        """Summarizes the chunks concurrently. Summaries are cached by the content hash of the chunk. Failed (None) or
+        empty summaries are not cached, so that they are requested again"""
+        keys = [hashlib.sha1(chunk.encode()).hexdigest() for chunk in chunks]
+        summaries = [summary_cache.get(key) for key in keys]
+        to_compute = [i for i, summary in enumerate(summaries) if summary is None]
+        outs = forward_many('gpt3_summarize', [((chunks[i],), {}) for i in to_compute], queues=self.queues)
+        for i, out in zip(to_compute, outs):
+            summaries[i] = out
+            if out:
+                summary_cache.put(keys[i], out)
+        return [summary if summary is not None else '' for summary in summaries]
+
     def frame_from_index(self, index) -> ImagePatch:
         """Returns the frame at position 'index', as an ImagePatch object."""
         if index < self.num_frames:
@@ -110,6 +129,7 @@ class VideoSegment:
 
         return VideoSegment(self.trimmed_video, self.annotation, start, end, self.start, queues=self.queues)
 
+    @timed('face_identify')
     def face_identify(self, image: ImagePatch) -> str:
         """Identifies the person in the given image and return an unique identifier."""
         # return self.forward('deepface', image, self.role_face_db)
@@ -129,69 +149,17 @@ class VideoSegment:
         role_id, self.role_face_db = self.forward('deepface', image, self.role_face_db)
         return role_id
 
+    @timed('select_answer')
     def select_answer(self, info: dict, question: str, options=None) -> str:
-        
-        import json
-
-        def info_summarize(info):
-            # prompt = f'You are given an json string that contains caption or query from frames in a video, please remove redundant information from the json string (for example, similar description in adjacent frame). And return the final response in json format. Please make the summarization result at most 3000 tokens. Here is json string you are asked to task:\n{info}\n'
-            prompt = f'{info}'
-            return self.forward('gpt3_summarize', prompt)
-            
         with open(config.select_answer_prompt, 'r') as f:
             prompt = f.read()
-        # info_formatting = '\n'.join([f"- {k}: {format_dict(v)}" for k, v in info.items()])
-        character_limit = 20000 - len(prompt)
-        chunk_limit = 10000
-
-        # info = json.dumps(info)
-        # print(f'before summarization got info length: {len(json.dumps(info))}')
-
-        round = 0
-        summarization = ""
-        chunk_message = {}
-        for key, value in info.items():
-            chunk_message[key] = value
-            if len(json.dumps(chunk_message)) > chunk_limit:
-                chunk_summarization = info_summarize(json.dumps(chunk_message))
-                summarization += '\n' + chunk_summarization
-
-                chunk_message_str = json.dumps(chunk_message, indent=4)
-                # print(f'============== round {round} ==============')
-                # print(f'\n{chunk_message_str}\n')
-                # print(f'\n{chunk_summarization}\n')
-
-                chunk_message = {}
-        if len(chunk_message) != 0:
-            chunk_summarization = info_summarize(json.dumps(chunk_message))
-            summarization += '\n' + chunk_summarization
-
-            # chunk_message_str = json.dumps(chunk_message, indent=4)
-            # print(f'============== round {round} ==============')
-            # print(f'\n{chunk_message_str}\n')
-            # print(f'\n{chunk_summarization}\n')
-
-        info = summarization
-        round += 1
-
-        while len(info) > character_limit:
-            summarization = ""
-            for start_idx in range(0, len(info), chunk_limit):
-                chunk_message = info[start_idx:start_idx + chunk_limit]
-                chunk_summarization = info_summarize(chunk_message)
-                summarization += '\n' + chunk_summarization
-
-                # print(f'============== round {round} ==============')
-                # print(f'\n{chunk_message}\n')
-                # print(f'\n{chunk_summarization}\n')
-
-            info = summarization
-            round += 1
-
-        # info_legnth = len(json.dumps(info))
-        # print(f'after summarization got info length: {info_legnth}')
-
-        # info_formatting = json.dumps(info)
+        character_limit = config.summarization.max_chars - len(prompt)
+
+        # Map: summarize the chunks of info concurrently. Reduce: while the summaries are too long, summarize them
+        # again in chunks
+        summaries = self.summarize_chunks(chunk_info(info, config.summarization.chunk_chars))
+        info = reduce_summaries(summaries, self.summarize_chunks, character_limit, config.summarization.chunk_chars)
+
         prompt = prompt.format(info=info, question=question, options=options)
         result = self.forward('gpt3_general', prompt, to_json=True)
         
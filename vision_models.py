@@ -5,20 +5,23 @@ process(name, *args, **kwargs), where *args and **kwargs are the arguments of th
 """
 
 import abc
+import io
+import json
+import threading
 import uuid
 import backoff
 import contextlib
-import cv2
+import math
 import numpy as np
-import openai
 import os
+import random
 import re
 import timeit
 import torch
 import torchvision
 import warnings
 from PIL import Image
-from collections import Counter
+from collections import Counter, deque
 from contextlib import redirect_stdout
 from functools import partial
 from itertools import chain
@@ -28,23 +31,14 @@ from torch import hub
 from torch.nn import functional as F
 from torchvision import transforms
 from typing import List, Optional, Union
-from deepface import DeepFace
 
+from completion import complete_function, defines_execute_command
 from configs import config
-from utils import HiddenPrints
-
-with open('api.key') as f:
-    openai.api_key = f.read().strip()
+from llm_client import LLMClient
+from utils import HiddenPrints, LRUCache, format_dict, hash_tensor
 
 import time
 import copy
-import google.generativeai as genai
-
-if os.environ.get('GEMINI_API_KEY') is None:
-    with open('gemini_api.key') as f:
-        genai.configure(api_key=f.read().strip())
-else:
-    genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
 
 cache = Memory('cache/' if config.use_cache else None, verbose=0)
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -52,6 +46,21 @@ console = Console(highlight=False)
 HiddenPrints = partial(HiddenPrints, console=console, use_newline=config.multiprocessing)
 
 
+# Heavy or API-client dependencies are imported when a model that needs them is created, so that importing this module
+# (and thus starting the processes) does not pay for models that are not in config.load_models
+openai = None
+
+
+def load_openai():
+    global openai
+    if openai is None:
+        import openai as openai_module
+        with open('api.key') as f:
+            openai_module.api_key = f.read().strip()
+        openai = openai_module
+    return openai
+
+
 # --------------------------- Base abstract model --------------------------- #
 
 class BaseModel(abc.ABC):
@@ -59,6 +68,7 @@ class BaseModel(abc.ABC):
     seconds_collect_data = 1.5  # Window of seconds to group inputs, if to_batch is True
     max_batch_size = 10  # Maximum batch size, if to_batch is True. Maximum allowed by OpenAI
     requires_gpu = True
+    concurrent_requests = False  # If True, the consumer sends several requests at the same time (always for API models)
     num_gpus = 1  # Number of required GPUs
     load_order = 0  # Order in which the model is loaded. Lower is first. By default, models are loaded alphabetically
 
@@ -92,6 +102,62 @@ class BaseModel(abc.ABC):
         """
         return [cls.name]
 
+    def stats(self) -> dict:
+        """Counters of the model (e.g. tokens used) that are reported at the end of the run"""
+        return {}
+
+
+def inference_size(image_size: int, max_size: int, max_upscale: float = None, multiple: int = 32) -> int:
+    """
+    Size at which to run a model that works at max_size, for an input of size image_size. Small inputs (e.g. crops)
+    are not upscaled more than max_upscale times. The size is rounded up to a multiple of `multiple`, so that inputs of
+    similar size end up with the same shape. If max_upscale is None, max_size is always used.
+    """
+    if max_upscale is None:
+        return max_size
+    size = math.ceil(image_size * max_upscale / multiple) * multiple
+    return int(min(max_size, size))
+
+
+def load_inference_weights(model, checkpoint_path, dev, prepare_state_dict=None, exclude_prefixes=(), strict=True):
+    """
+    Moves the model to dev and loads the weights of checkpoint_path into it. The first time, the (pickled) checkpoint
+    is read with torch.load, and the weights used at inference (the ones in the model, excluding exclude_prefixes) are
+    stored next to it as a .safetensors file. Later runs memory-map that file, and the weights are copied from it into
+    the model, so there is only one copy of them in the device. prepare_state_dict is applied to the loaded checkpoint
+    to get the state dict (e.g. to select a key or reshape weights).
+    """
+    from safetensors.torch import load_file, save_file
+
+    model = model.to(dev)
+    converted_path = os.path.splitext(checkpoint_path)[0] + '.inference.safetensors'
+    state_dict = None
+    if config.fast_checkpoint_loading and os.path.exists(converted_path):
+        try:
+            state_dict = load_file(converted_path, device='cpu')  # Memory-mapped
+        except Exception as e:
+            warnings.warn(f'Could not read {converted_path} ({e}). Loading {checkpoint_path} instead')
+    if state_dict is None:
+        state_dict = torch.load(checkpoint_path, map_location='cpu')
+        if prepare_state_dict is not None:
+            state_dict = prepare_state_dict(state_dict)
+        model_keys = set(model.state_dict().keys())
+        state_dict = {k: v for k, v in state_dict.items()
+                      if (k in model_keys or strict) and not k.startswith(tuple(exclude_prefixes))}
+        if config.fast_checkpoint_loading:
+            # Written to a temporary file and renamed, so that other processes loading the same model (replicas) never
+            # read a partially written file. If it cannot be written (e.g. read-only directory), the checkpoint is used
+            tmp_path = f'{converted_path}.{os.getpid()}.tmp'
+            try:
+                # Clone, as safetensors does not store tensors that share memory
+                save_file({k: v.contiguous().clone() for k, v in state_dict.items()}, tmp_path)
+                os.replace(tmp_path, converted_path)
+            except OSError as e:
+                warnings.warn(f'Could not write {converted_path} ({e}). The checkpoint will be loaded every time')
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return model.load_state_dict(state_dict, strict=strict)
+
 
 # ------------------------------ Specific models ---------------------------- #
 
@@ -332,14 +398,23 @@ class CLIPModel(BaseModel):
 class MaskRCNNModel(BaseModel):
     name = 'maskrcnn'
 
-    def __init__(self, gpu_number=1, threshold=config.detect_thresholds.maskrcnn):
+    def __init__(self, gpu_number=1, threshold=config.detect_thresholds.maskrcnn,
+                 detector=config.maskrcnn.detector, predict_masks=config.maskrcnn.predict_masks):
         super().__init__(gpu_number)
+        assert detector in ['maskrcnn_resnet50_fpn_v2', 'fasterrcnn_resnet50_fpn_v2',
+                            'fasterrcnn_mobilenet_v3_large_fpn']
         # with HiddenPrints('MaskRCNN'):
-        obj_detect = torchvision.models.detection.maskrcnn_resnet50_fpn_v2(weights='COCO_V1').to(self.dev)
+        weights = torchvision.models.get_model_weights(detector).COCO_V1
+        obj_detect = torchvision.models.get_model(detector, weights=weights).to(self.dev)
         obj_detect.eval()
         obj_detect.requires_grad_(False)
+        if not predict_masks and obj_detect.roi_heads.has_mask():
+            # Only boxes and labels are returned, so do not run the mask branch at all
+            obj_detect.roi_heads.mask_roi_pool = None
+            obj_detect.roi_heads.mask_head = None
+            obj_detect.roi_heads.mask_predictor = None
 
-        self.categories = torchvision.models.detection.MaskRCNN_ResNet50_FPN_V2_Weights.COCO_V1.meta['categories']
+        self.categories = weights.meta['categories']
         self.obj_detect = obj_detect
         self.threshold = threshold
 
@@ -354,7 +429,7 @@ class MaskRCNNModel(BaseModel):
         images = [self.prepare_image(im) for im in images]
         detections = self.obj_detect(images)
         for i in range(len(images)):
-            height = detections[i]['masks'].shape[-2]
+            height = images[i].shape[-2]
             # Just return boxes (no labels no masks, no scores) with scores > threshold
             if return_labels:  # In the current implementation, we only return labels
                 d_i = detections[i]['labels'][detections[i]['scores'] > self.threshold]
@@ -477,31 +552,79 @@ class GLIPModel(BaseModel):
                 self.plus = plus
                 self.color = 255
 
-            @torch.no_grad()
-            def compute_prediction(self, original_image, original_caption, custom_entity=None):
-                image = self.transforms(original_image)
-                # image = [image, image.permute(0, 2, 1)]
-                image_list = to_image_list(image, self.cfg.DATALOADER.SIZE_DIVISIBILITY)
-                image_list = image_list.to(self.dev)
-                # caption
-                if isinstance(original_caption, list):
-
-                    if len(original_caption) > 40:
-                        all_predictions = None
-                        for loop_num, i in enumerate(range(0, len(original_caption), 40)):
-                            list_step = original_caption[i:i + 40]
-                            prediction_step = self.compute_prediction(original_image, list_step, custom_entity=None)
-                            if all_predictions is None:
-                                all_predictions = prediction_step
-                            else:
-                                # Aggregate predictions
-                                all_predictions.bbox = torch.cat((all_predictions.bbox, prediction_step.bbox), dim=0)
-                                for k in all_predictions.extra_fields:
-                                    all_predictions.extra_fields[k] = \
-                                        torch.cat((all_predictions.extra_fields[k],
-                                                   prediction_step.extra_fields[k] + loop_num), dim=0)
-                        return all_predictions
+                # Transforms for every inference size used so far. See set_min_image_size
+                self.default_min_image_size = self.min_image_size
+                self.transforms_per_size = {self.min_image_size: self.transforms}
+
+                # Programs call find() with the same object names on every frame, so the language side (NER,
+                # tokenization, positive map and text encoder) is cached per caption
+                self.caption_cache = LRUCache(config.glip.language_cache_size)
+                self.text_feature_cache = LRUCache(config.glip.language_cache_size)
+                self.timings = {'language': 0., 'vision': 0., 'calls': 0}
+                self._text_encoder_time = 0.
+                if hasattr(self.model, 'language_backbone'):
+                    self.cache_language_backbone(self.model.language_backbone)
+
+                # Programs also call find() on the same frame for several object names. Unless the backbone itself
+                # is language-conditioned, its output only depends on the image, so it is cached per image content
+                self.visual_feature_cache = LRUCache(None, max_bytes=config.glip.visual_cache_mb * 2 ** 20)
+                self._image_key = None
+                if 'vl' not in self.cfg.MODEL.SWINT.VERSION:
+                    self.cache_visual_backbone(self.model.backbone)
+
+            def cache_language_backbone(self, language_backbone):
+                """
+                Memoize the output of the text encoder per tokenized caption. The model only runs in inference
+                mode, so the features for a given caption never change.
+                """
+                forward_fn = language_backbone.forward
+
+                def cached_forward(tokenizer_input):
+                    tic = timeit.time.perf_counter()
+                    key = (tuple(tokenizer_input['input_ids'].flatten().tolist()),
+                           tuple(tokenizer_input['attention_mask'].flatten().tolist()))
+                    language_dict_features = self.text_feature_cache.get(key)
+                    if language_dict_features is None:
+                        language_dict_features = forward_fn(tokenizer_input)
+                        self.text_feature_cache.put(key, language_dict_features)
+                    if config.glip.profile and torch.cuda.is_available():
+                        torch.cuda.synchronize(self.dev)
+                    self._text_encoder_time += timeit.time.perf_counter() - tic
+                    # The fusion layers replace entries of this dict, so do not give away the cached one
+                    return dict(language_dict_features)
+
+                language_backbone.forward = cached_forward
+
+            def cache_visual_backbone(self, backbone):
+                """
+                Memoize the output of the visual backbone (+FPN) for the image being processed. Only the
+                language-conditioned fusion and the heads are run for a new caption on a cached image.
+                """
+                forward_fn = backbone.forward
+
+                def cached_forward(images):
+                    if self._image_key is None:
+                        return forward_fn(images)
+                    key = (self._image_key, tuple(images.shape))
+                    visual_features = self.visual_feature_cache.get(key)
+                    if visual_features is None:
+                        visual_features = forward_fn(images)
+                        self.visual_feature_cache.put(key, visual_features)
+                    return visual_features
+
+                backbone.forward = cached_forward
+
+            def prepare_caption(self, original_caption, custom_entity=None):
+                """
+                Returns the caption string given to the model and the positive map (label -> tokens) for it
+                """
+                key = tuple(original_caption) if isinstance(original_caption, list) else original_caption
+                if custom_entity is None:
+                    cached = self.caption_cache.get(key)
+                    if cached is not None:
+                        return cached
 
+                if isinstance(original_caption, list):
                     # we directly provided a list of category names
                     caption_string = ""
                     tokens_positive = []
@@ -527,15 +650,57 @@ class GLIPModel(BaseModel):
 
                 positive_map_label_to_token = create_positive_map_label_to_token_from_positive_map(positive_map,
                                                                                                    plus=self.plus)
-                self.positive_map_label_to_token = positive_map_label_to_token
+                prepared = (original_caption, positive_map_label_to_token)
+                if custom_entity is None:
+                    self.caption_cache.put(key, prepared)
+                return prepared
+
+            @torch.no_grad()
+            def compute_prediction(self, original_image, original_caption, custom_entity=None):
+                image = self.transforms(original_image)
+                # image = [image, image.permute(0, 2, 1)]
+                image_list = to_image_list(image, self.cfg.DATALOADER.SIZE_DIVISIBILITY)
+                image_list = image_list.to(self.dev)
+                # caption
+                if isinstance(original_caption, list):
+
+                    if len(original_caption) > 40:
+                        all_predictions = None
+                        for loop_num, i in enumerate(range(0, len(original_caption), 40)):
+                            list_step = original_caption[i:i + 40]
+                            prediction_step = self.compute_prediction(original_image, list_step, custom_entity=None)
+                            if all_predictions is None:
+                                all_predictions = prediction_step
+                            else:
+                                # Aggregate predictions
+                                all_predictions.bbox = torch.cat((all_predictions.bbox, prediction_step.bbox), dim=0)
+                                for k in all_predictions.extra_fields:
+                                    all_predictions.extra_fields[k] = \
+                                        torch.cat((all_predictions.extra_fields[k],
+                                                   prediction_step.extra_fields[k] + loop_num), dim=0)
+                        return all_predictions
+
                 tic = timeit.time.perf_counter()
+                original_caption, positive_map_label_to_token = self.prepare_caption(original_caption, custom_entity)
+                self.positive_map_label_to_token = positive_map_label_to_token
+                toc = timeit.time.perf_counter()
 
                 # compute predictions
                 # with HiddenPrints():  # Hide some deprecated notices
+                self._text_encoder_time = 0.
+                self._image_key = hash_tensor(original_image) if config.glip.visual_cache_mb > 0 else None
                 predictions = self.model(image_list, captions=[original_caption],
                                             positive_map=positive_map_label_to_token)
                 predictions = [o.to(self.cpu_device) for o in predictions]
-                # print("inference time per image: {}".format(timeit.time.perf_counter() - tic))
+
+                time_language = toc - tic + self._text_encoder_time
+                time_vision = timeit.time.perf_counter() - toc - self._text_encoder_time
+                self.timings['language'] += time_language
+                self.timings['vision'] += time_vision
+                self.timings['calls'] += 1
+                if config.glip.profile:
+                    print(f"GLIP inference time per image: language {time_language * 1000:.1f}ms, "
+                          f"vision {time_vision * 1000:.1f}ms")
 
                 # always single image is passed at a time
                 prediction = predictions[0]
@@ -557,6 +722,13 @@ class GLIPModel(BaseModel):
 
                 return prediction
 
+            def set_min_image_size(self, min_image_size):
+                if min_image_size not in self.transforms_per_size:
+                    self.min_image_size = min_image_size
+                    self.transforms_per_size[min_image_size] = self.build_transform()
+                self.min_image_size = min_image_size
+                self.transforms = self.transforms_per_size[min_image_size]
+
             @staticmethod
             def to_left_right_upper_lower(bboxes):
                 return [(bbox[1], bbox[3], bbox[0], bbox[2]) for bbox in bboxes]
@@ -586,10 +758,13 @@ class GLIPModel(BaseModel):
                 # Avoid the resizing creating a huge image in a pathological case
                 ratio = image.shape[1] / image.shape[2]
                 ratio = max(ratio, 1 / ratio)
-                original_min_image_size = self.min_image_size
+                min_image_size = self.default_min_image_size
                 if ratio > 10:
-                    self.min_image_size = int(original_min_image_size * 10 / ratio)
-                    self.transforms = self.build_transform()
+                    min_image_size = int(min_image_size * 10 / ratio)
+                # Do not upscale small crops all the way to min_image_size
+                min_image_size = inference_size(min(image.shape[1:]), min_image_size, config.glip.max_upscale,
+                                                max(self.cfg.DATALOADER.SIZE_DIVISIBILITY, 1))
+                self.set_min_image_size(min_image_size)
 
                 with torch.cuda.device(self.dev):
                     inference_output = self.inference(image, obj)
@@ -597,10 +772,6 @@ class GLIPModel(BaseModel):
                 bboxes = inference_output.bbox.cpu().numpy().astype(int)
                 # bboxes = self.to_left_right_upper_lower(bboxes)
 
-                if ratio > 10:
-                    self.min_image_size = original_min_image_size
-                    self.transforms = self.build_transform()
-
                 bboxes = torch.tensor(bboxes)
 
                 # Convert to [left, lower, right, upper] instead of [left, upper, right, lower]
@@ -630,7 +801,7 @@ class TCLModel(BaseModel):
         from base_models.tcl.tcl_tokenization_bert import BertTokenizer
 
         super().__init__(gpu_number)
-        config = {
+        tcl_config = {
             'image_res': 384,
             'mlm_probability': 0.15,
             'embed_dim': 256,
@@ -647,25 +818,27 @@ class TCLModel(BaseModel):
         self.tokenizer = BertTokenizer.from_pretrained(text_encoder)
 
         # with warnings.catch_warnings(), HiddenPrints("TCL"):
-        model = ALBEF(config=config, text_encoder=text_encoder, tokenizer=self.tokenizer)
+        model = ALBEF(config=tcl_config, text_encoder=text_encoder, tokenizer=self.tokenizer)
 
-        checkpoint = torch.load(checkpoint_path, map_location='cpu')
-        state_dict = checkpoint['model']
+        def prepare_state_dict(checkpoint):
+            state_dict = checkpoint['model']
+            # reshape positional embedding to accomodate for image resolution change
+            pos_embed_reshaped = interpolate_pos_embed(state_dict['visual_encoder.pos_embed'], model.visual_encoder)
+            state_dict['visual_encoder.pos_embed'] = pos_embed_reshaped
+            return state_dict
 
-        # reshape positional embedding to accomodate for image resolution change
-        pos_embed_reshaped = interpolate_pos_embed(state_dict['visual_encoder.pos_embed'], model.visual_encoder)
-        state_dict['visual_encoder.pos_embed'] = pos_embed_reshaped
-        m_pos_embed_reshaped = interpolate_pos_embed(state_dict['visual_encoder_m.pos_embed'],
-                                                        model.visual_encoder_m)
-        state_dict['visual_encoder_m.pos_embed'] = m_pos_embed_reshaped
-        model.load_state_dict(state_dict, strict=False)
+        # The momentum encoders and the queues are only used for training
+        load_inference_weights(model, checkpoint_path, self.dev, prepare_state_dict, strict=False,
+                               exclude_prefixes=('visual_encoder_m.', 'text_encoder_m.', 'vision_proj_m.',
+                                                 'text_proj_m.', 'image_queue', 'text_queue', 'idx_queue',
+                                                 'queue_ptr'))
 
         self.model = model.to(self.dev)
         self.model.eval()
 
         normalize = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
         self.test_transform = transforms.Compose([
-            transforms.Resize((config['image_res'], config['image_res']), interpolation=Image.BICUBIC),
+            transforms.Resize((tcl_config['image_res'], tcl_config['image_res']), interpolation=Image.BICUBIC),
             transforms.ToTensor(),
             normalize,
         ])
@@ -796,6 +969,7 @@ class GPT3Model(BaseModel):
 
     def __init__(self, gpu_number=0):
         super().__init__(gpu_number=gpu_number)
+        load_openai()
         with open(config.gpt3.qa_prompt) as f:
             self.qa_prompt = f.read().strip()
         with open(config.gpt3.guess_prompt) as f:
@@ -803,6 +977,7 @@ class GPT3Model(BaseModel):
         self.temperature = config.gpt3.temperature
         self.n_votes = config.gpt3.n_votes
         self.model = config.gpt3.model
+        self.client = LLMClient(self.name)
 
     # initial cleaning for reference QA results
     @staticmethod
@@ -911,7 +1086,8 @@ class GPT3Model(BaseModel):
                 }
             ]
             try:
-                response = openai.ChatCompletion.create(
+                response = self.create(
+                    openai.ChatCompletion.create,
                     model=self.model,
                     messages=message,
                     # response_format={"type": "json_object"},
@@ -919,15 +1095,20 @@ class GPT3Model(BaseModel):
                 )
                 responses.append(response.choices[0].message.content)
             except:
-                responses.append("")
+                responses.append(None)  # Not cached, so that it is requested again
             
         return responses
 
+    def create(self, create_fn, **kwargs):
+        """Sends the request through the client, which records its usage"""
+        return self.client.call(create_fn, usage_of=partial(openai_usage, kwargs['model']), **kwargs)
+
     def query_gpt3(self, prompt, model="text-davinci-003", max_tokens=16, logprobs=None, stream=False,
                    stop=None, top_p=1, frequency_penalty=0, presence_penalty=0, to_json=False):
         if 'gpt' in model:
             messages = [{"role": "user", "content": p} for p in prompt]
-            response = openai.ChatCompletion.create(
+            response = self.create(
+                openai.ChatCompletion.create,
                 model=model,
                 messages=messages,
                 max_tokens=max_tokens,
@@ -935,7 +1116,8 @@ class GPT3Model(BaseModel):
                 response_format=None if not to_json else { "type": "json_object" },
             )
         else:
-            response = openai.Completion.create(
+            response = self.create(
+                openai.Completion.create,
                 model=model,
                 prompt=prompt,
                 max_tokens=max_tokens,
@@ -1000,33 +1182,164 @@ class GPT3Model(BaseModel):
     def list_processes(cls):
         return ['gpt3_' + n for n in ['qa', 'guess', 'general', 'summarize']]
 
+    def stats(self):
+        return self.client.stats()
 
-# @cache.cache
-@backoff.on_exception(backoff.expo, Exception, max_tries=10)
-def codex_helper(messages):
-    # message should be nested list
-    assert 0 <= config.codex.temperature <= 1
-    assert 1 <= config.codex.best_of <= 20
 
-    responses = []
-    for message in messages:
-        response = openai.ChatCompletion.create(
+def count_tokens(text):
+    """Number of tokens of text for config.codex.model. Estimated from the length if tiktoken is not installed"""
+    try:
+        import tiktoken
+    except ImportError:
+        return math.ceil(len(text) / 4)
+    try:
+        encoding = tiktoken.encoding_for_model(config.codex.model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class ProgramCache:
+    """
+    Generated programs, looked up by their filled prototype prompt. In 'semantic' mode, a stored program is returned if
+    the embedding of its prompt is similar enough to the embedding of the new one (e.g. the same question about another
+    video, or a paraphrase). In 'exact' mode, only for the same prompt. Programs are appended to
+    config.program_cache.path (json lines), so that they are shared across runs. Only programs that parse are stored.
+    """
+
+    def __init__(self):
+        self.prompts = []
+        self.codes = []
+        self.embeddings = []
+        self.matrix = None  # Normalized embeddings, stacked
+        self.lock = threading.Lock()
+        path = config.program_cache.path
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.prompts.append(entry['prompt'])
+                    self.codes.append(entry['code'])
+                    self.embeddings.append(np.array(entry['embedding'], dtype=np.float32))
+        self.index = {prompt: i for i, prompt in enumerate(self.prompts)}
+
+    @staticmethod
+    def embed(texts):
+        response = openai.Embedding.create(model=config.program_cache.embedding_model, input=texts)
+        embeddings = np.array([d['embedding'] for d in response['data']], dtype=np.float32)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def lookup(self, prompts):
+        """Returns the stored program for every prompt (None if there is none), and the embeddings of the prompts"""
+        if config.program_cache.mode == 'exact':
+            with self.lock:
+                return [self.codes[self.index[p]] if p in self.index else None for p in prompts], None
+        embeddings = self.embed(prompts)
+        with self.lock:
+            if len(self.embeddings) == 0:
+                return [None] * len(prompts), embeddings
+            if self.matrix is None or len(self.matrix) != len(self.embeddings):
+                self.matrix = np.stack(self.embeddings)
+            similarity = embeddings @ self.matrix.T
+            best = similarity.argmax(axis=1)
+            codes = [self.codes[b] if similarity[i, b] >= config.program_cache.threshold else None
+                     for i, b in enumerate(best)]
+            return codes, embeddings
+
+    def add(self, prompt, code, embedding=None):
+        if not defines_execute_command(code):
+            return
+        if embedding is None:
+            embedding = self.embed([prompt])[0]
+        with self.lock:
+            self.index[prompt] = len(self.prompts)
+            self.prompts.append(prompt)
+            self.codes.append(code)
+            self.embeddings.append(embedding)
+            if config.program_cache.path:
+                os.makedirs(os.path.dirname(config.program_cache.path) or '.', exist_ok=True)
+                with open(config.program_cache.path, 'a') as f:
+                    f.write(json.dumps({'prompt': prompt, 'code': code, 'embedding': embedding.tolist()}) + '\n')
+
+
+def stream_completion(message, temperature):
+    """
+    Streams the completion of message, and stops as soon as it contains a complete execute_command function. Returns
+    that function (or the whole completion if it ended on its own), and the text that was streamed (for its usage)
+    """
+    response = openai.ChatCompletion.create(
+        model=config.codex.model,
+        messages=message,
+        temperature=temperature,
+        max_tokens=config.codex.max_tokens,
+        top_p=1.,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stop=["\n\n\n"],
+        stream=True,
+    )
+    text = ''
+    code = None
+    for chunk in response:
+        delta = chunk['choices'][0]['delta'].get('content', '')
+        text += delta
+        if '\n' in delta:
+            code = complete_function(text)
+            if code is not None:
+                break
+    if hasattr(response, 'close'):
+        response.close()  # Stop receiving the rest of the completion
+    # When stopped early, the text ends with part of the line after the function
+    return (text if code is None else code), text
+
+
+def openai_usage(model, response):
+    """(model, prompt tokens, completion tokens) of an OpenAI response, for LLMClient.call"""
+    usage = response.get('usage', {})
+    return model, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+
+
+@backoff.on_exception(backoff.expo, Exception, max_tries=config.llm_client.max_tries)
+def codex_message(message, temperature, client: LLMClient = None):
+    """Code for one message. Retried on its own, so that the messages of the batch that succeeded are not sent (and
+    their usage recorded) again"""
+    # With a client, every request is hedged, has a deadline and its usage is recorded
+    call = client.call if client is not None else lambda fn, *args, usage_of=None, **kwargs: fn(*args, **kwargs)
+    if config.codex.stream:
+        prompt_tokens = sum(count_tokens(m['content']) for m in message)
+        text, _ = call(stream_completion, message, temperature,
+                       usage_of=lambda out: (config.codex.model, prompt_tokens, count_tokens(out[1])))
+    else:
+        response = call(
+            openai.ChatCompletion.create,
             model=config.codex.model,
             messages=message,
-            temperature=config.codex.temperature,
+            temperature=temperature,
             max_tokens=config.codex.max_tokens,
             top_p=1.,
             frequency_penalty=0,
             presence_penalty=0,
             #                 best_of=config.codex.best_of,
             stop=["\n\n\n"],
+            usage_of=partial(openai_usage, config.codex.model),
         )
         # print(response)
-        responses.append(response)
+        text = response['choices'][0]['message']['content']
+    return text
+
+
+# @cache.cache
+def codex_helper(messages, temperature=None, client: LLMClient = None):
+    # message should be nested list
+    temperature = config.codex.temperature if temperature is None else temperature
+    assert 0 <= temperature <= 1
+    assert 1 <= config.codex.best_of <= 20
 
-    resp = [r['choices'][0]['message']['content'].replace("execute_command(image)",
-                                                            "execute_command(image, my_fig, time_wait_between_lines, syntax)")
-            for r in responses]
+    resp = []
+    for message in messages:
+        text = codex_message(message, temperature, client)
+        resp.append(text.replace("execute_command(image)",
+                                 "execute_command(image, my_fig, time_wait_between_lines, syntax)"))
 
     filtered_resp = []
     for r in resp:
@@ -1046,12 +1359,58 @@ class CodexModel(BaseModel):
 
     def __init__(self, gpu_number=0):
         super().__init__(gpu_number=gpu_number)
+        load_openai()
 
         self.api_spec = open(config.codex.api_prompt).read().strip()
         self.function_signature = open(config.codex.function_signature_prompt).read().strip()
         self.function_format = open(config.codex.function_format_prompt).read().strip()
-        self.examples = '\n'.join([open(ep).read().strip() for ep in config.codex.example_prompt])
+        self.example_list = [open(ep).read().strip() for ep in config.codex.example_prompt]
         self.prototype = open(config.codex.prototype_prompt).read().strip()
+        # "Answer should only include a function named execute_command, and the function should contains multiple line of comments for explaination in function body"
+        self.system_message = "You are a professional programmer. You would be asked to follow the API specification and examples to complete the function."  # Or analyze the code and request a new API to solve the problem."
+
+        # The instruction is the same for every prompt, so it is built (and its tokens counted) only once
+        self.examples, self.instruction = self.build_instruction()
+        self.client = LLMClient(self.name)
+        self.program_cache = ProgramCache() if config.program_cache.enabled else None
+        self.programs_from_cache = 0
+        self.lock = threading.Lock()  # The consumer calls the model from several threads
+
+    def instruction_template(self, examples):
+        return f"""You are only allowed to use imported package and defined class below to complete the function:
+            {self.api_spec}
+            The function parameter and return value should follow the signature below:
+            {self.function_signature}
+            Here's some function examples to refer:
+            {examples}
+            Please follow the format to return the function. 
+            {self.function_format}
+            You MUST return the function ONLY and DO NOT return any unrelevant content.
+            """
+
+    def build_instruction(self):
+        """
+        Returns the examples and the instruction. If config.codex.prompt_token_budget is set, the last examples are
+        dropped until the system message and the instruction fit in it
+        """
+        budget = config.codex.prompt_token_budget
+        num_examples = len(self.example_list)
+        while True:
+            examples = '\n'.join(self.example_list[:num_examples])
+            instruction = self.instruction_template(examples)
+            total = count_tokens(self.system_message) + count_tokens(instruction)
+            if budget is None or total <= budget or num_examples == 0:
+                break
+            num_examples -= 1
+        if budget is not None and total > budget:
+            warnings.warn(f'The Codex prompt takes {total} tokens without examples, over the budget of {budget}')
+
+        components = {'system': count_tokens(self.system_message), 'api_spec': count_tokens(self.api_spec),
+                      'function_signature': count_tokens(self.function_signature),
+                      'examples': count_tokens(examples), 'function_format': count_tokens(self.function_format)}
+        console.print(f'Codex prompt: {total} tokens ({format_dict(components)}\n) with {num_examples} of '
+                      f'{len(self.example_list)} examples')
+        return examples, instruction
 
     def format_messages(self, extended_prompt):
         if not isinstance(extended_prompt, list):
@@ -1061,28 +1420,29 @@ class CodexModel(BaseModel):
         for prompt in extended_prompt:
             message = [{
                 "role": "system",
-                # "content":  "Answer should only include a function named execute_command, and the function should contains multiple line of comments for explaination in function body"
-                'content': "You are a professional programmer. You would be asked to follow the API specification and examples to complete the function."# Or analyze the code and request a new API to solve the problem."
+                'content': self.system_message
             }]
-            instruction = f"""You are only allowed to use imported package and defined class below to complete the function:
-            {self.api_spec}
-            The function parameter and return value should follow the signature below:
-            {self.function_signature}
-            Here's some function examples to refer:
-            {self.examples}
-            Please follow the format to return the function. 
-            {self.function_format}
-            You MUST return the function ONLY and DO NOT return any unrelevant content.
-            """
             message.append({
                 "role": "user",
-                "content": str(instruction + prompt)
+                "content": str(self.instruction + prompt)
             })
             messages.append(message)
 
         return messages
 
-    def forward(self, prompt, input_type='image', extra_context=None):
+    def stats(self):
+        stats = self.client.stats()
+        if self.program_cache is not None:
+            with self.lock:
+                stats['programs_from_cache'] = self.programs_from_cache
+        return stats
+
+    def forward(self, prompt, input_type='image', extra_context=None, temperature=None, return_cache_info=False):
+        """
+        Returns the generated code and the messages sent for it. If return_cache_info, also whether the code of every
+        prompt was served from the program cache. Code requested with a specific temperature (to get a different
+        program) is never served from the cache.
+        """
         if isinstance(prompt, list):
             extended_prompt = [self.prototype.replace("INSERT_QUERY_HERE", p).
                                replace('INSERT_TYPE_HERE', input_type).
@@ -1096,19 +1456,38 @@ class CodexModel(BaseModel):
             raise TypeError("prompt must be a string or a list of strings")
 
         messages = self.format_messages(extended_prompt)
-        result = self.forward_(messages)
+        if self.program_cache is not None and temperature is None:
+            result, embeddings = self.program_cache.lookup(extended_prompt)
+        else:
+            result, embeddings = [None] * len(extended_prompt), None
+        from_cache = [r is not None for r in result]
+        to_generate = [i for i, r in enumerate(result) if r is None]
+        if len(to_generate) > 0:
+            generated = self.forward_([messages[i] for i in to_generate], temperature)
+            for i, code in zip(to_generate, generated):
+                result[i] = code
+                if self.program_cache is not None:
+                    self.program_cache.add(extended_prompt[i], code, None if embeddings is None else embeddings[i])
+        with self.lock:
+            self.programs_from_cache += sum(from_cache)
         if not isinstance(prompt, list):
-            result = result[0]
+            result, from_cache = result[0], from_cache[0]
+        if return_cache_info:
+            return result, messages, from_cache
         return result, messages
 
-    def forward_(self, messages):
+    def forward_(self, messages, temperature=None, attempt=0):
         if len(messages) > self.max_batch_size:
             response = []
             for i in range(0, len(messages), self.max_batch_size):
-                response += self.forward_(messages[i:i + self.max_batch_size])
+                response += self.forward_(messages[i:i + self.max_batch_size], temperature)
             return response
+        if attempt > config.llm_client.max_retries:
+            # Empty code does not compile, so it is requested again (see main_batch.regenerate)
+            warnings.warn(f"Codex failed {attempt} times, giving up on {len(messages)} prompts")
+            return [''] * len(messages)
         try:
-            response = codex_helper( messages)
+            response = codex_helper(messages, temperature, self.client)
         except openai.error.RateLimitError as e:
             print("Retrying Codex, splitting batch")
             if len(messages) == 1:
@@ -1118,19 +1497,19 @@ class CodexModel(BaseModel):
             sub_batch_1 = messages[:len(messages) // 2]
             sub_batch_2 = messages[len(messages) // 2:]
             if len(sub_batch_1) > 0:
-                response_1 = self.forward_(sub_batch_1)
+                response_1 = self.forward_(sub_batch_1, temperature, attempt + 1)
             else:
                 response_1 = []
             if len(sub_batch_2) > 0:
-                response_2 = self.forward_(sub_batch_2)
+                response_2 = self.forward_(sub_batch_2, temperature, attempt + 1)
             else:
                 response_2 = []
             response = response_1 + response_2
         except Exception as e:
-            # Some other error like an internal OpenAI error
+            # Some other error like an internal OpenAI error, or a missed deadline
             print("Retrying Codex")
             print(e)
-            response = self.forward_(messages)
+            response = self.forward_(messages, temperature, attempt + 1)
         return response
 
 class ReflectionModel(BaseModel):
@@ -1142,8 +1521,10 @@ class ReflectionModel(BaseModel):
 
     def __init__(self, gpu_number=0):
         super().__init__(gpu_number=gpu_number)
+        load_openai()
 
         self.reflection_examples = [open(ep).read().strip() for ep in config.codex.reflection_example_prompt]
+        self.client = LLMClient(self.name)
 
     def format_messages(self, codes, original_messages, reflection):
         # messages = []
@@ -1227,14 +1608,17 @@ class ReflectionModel(BaseModel):
             result = result[0]
         return result
 
-    def forward_(self, messages):
+    def forward_(self, messages, attempt=0):
         if len(messages) > self.max_batch_size:
             response = []
             for i in range(0, len(messages), self.max_batch_size):
                 response += self.forward_(messages[i:i + self.max_batch_size])
             return response
+        if attempt > config.llm_client.max_retries:
+            warnings.warn(f"Reflection failed {attempt} times, giving up on {len(messages)} prompts")
+            return [''] * len(messages)
         try:
-            response = codex_helper(messages)
+            response = codex_helper(messages, client=self.client)
         except openai.error.RateLimitError as e:
             print("Retrying Codex, splitting batch")
             if len(messages) == 1:
@@ -1244,31 +1628,33 @@ class ReflectionModel(BaseModel):
             sub_batch_1 = messages[:len(messages) // 2]
             sub_batch_2 = messages[len(messages) // 2:]
             if len(sub_batch_1) > 0:
-                response_1 = self.forward_(sub_batch_1)
+                response_1 = self.forward_(sub_batch_1, attempt + 1)
             else:
                 response_1 = []
             if len(sub_batch_2) > 0:
-                response_2 = self.forward_(sub_batch_2)
+                response_2 = self.forward_(sub_batch_2, attempt + 1)
             else:
                 response_2 = []
             response = response_1 + response_2
         except Exception as e:
-            # Some other error like an internal OpenAI error
+            # Some other error like an internal OpenAI error, or a missed deadline
             print("Retrying Codex")
             print(e)
-            response = self.forward_(messages)
+            response = self.forward_(messages, attempt + 1)
         return response
 
+    def stats(self):
+        return self.client.stats()
+
 
 
 class CodeLlama(CodexModel):
     name = 'codellama'
     requires_gpu = True
-    max_batch_size = 3
+    concurrent_requests = True  # Prompts of concurrent requests join the batch of the generation engine
+    max_batch_size = 8  # Sequences decoded at the same time
     load_order = 1  # Load this model last
 
-    # Not batched, but every call will probably be a batch (coming from the same process)
-
     def __init__(self, gpu_number=0):
         super().__init__(gpu_number=gpu_number)
 
@@ -1289,46 +1675,53 @@ class CodeLlama(CodexModel):
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = 'left'
 
-        # Compute this when the other models have already been loaded
-        # Ignore gpu number
-        usage_ratio = 0.15  # If it is small, it will use more GPUs, which will allow larger batch sizes
-        leave_empty = 0.7  # If other models are using more than (1-leave_empty) of memory, do not use
-        max_memory = {}
-        for gpu_number in range(torch.cuda.device_count()):
-            mem_available = torch.cuda.mem_get_info(f'cuda:{gpu_number}')[0]
-            if mem_available <= leave_empty * torch.cuda.get_device_properties(gpu_number).total_memory:
-                mem_available = 0
-            max_memory[gpu_number] = mem_available * usage_ratio
-            if gpu_number == 0:
-                max_memory[gpu_number] /= 10
-        self.model = LlamaForCausalLM.from_pretrained(
-            model_id,
-            torch_dtype=torch.float16,
-            # load_in_8bit=True,  # For some reason this results in OOM when doing forward pass
-            device_map="sequential",
-            max_memory=max_memory,
-        )
+        if device == 'cpu':
+            max_memory = None
+        elif config.placement.enabled:
+            # The placement planner chose a GPU with room for the model (see placement.py)
+            max_memory = {gpu_number: torch.cuda.mem_get_info(self.dev)[0]}
+        else:
+            # Compute this when the other models have already been loaded
+            usage_ratio = 0.15  # If it is small, it will use more GPUs, which will allow larger batch sizes
+            leave_empty = 0.7  # If other models are using more than (1-leave_empty) of memory, do not use
+            max_memory = {}
+            for gpu_number_ in range(torch.cuda.device_count()):
+                mem_available = torch.cuda.mem_get_info(f'cuda:{gpu_number_}')[0]
+                if mem_available <= leave_empty * torch.cuda.get_device_properties(gpu_number_).total_memory:
+                    mem_available = 0
+                max_memory[gpu_number_] = mem_available * usage_ratio
+                if gpu_number_ == 0:
+                    max_memory[gpu_number_] /= 10
+        if max_memory is None:
+            self.model = LlamaForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32)
+        else:
+            self.model = LlamaForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=torch.float16,
+                # load_in_8bit=True,  # For some reason this results in OOM when doing forward pass
+                device_map="sequential",
+                max_memory=max_memory,
+            )
         self.model.eval()
 
+        # The system message and the instruction (API, signature, examples) are the same for all the queries, so their
+        # key/value cache is computed once
+        from generation_engine import GenerationEngine
+        prefix = self.message_to_text(self.format_messages('')[0])
+        self.engine = GenerationEngine(self.model, self.tokenizer, prefix=prefix, max_batch_size=self.max_batch_size,
+                                       max_new_tokens=config.codex.codellama_max_new_tokens)
+
+    @staticmethod
+    def message_to_text(message):
+        return '\n'.join(m['content'] for m in message)
+
     def run_codellama(self, prompt):
-        input_ids = self.tokenizer(prompt, return_tensors="pt", padding=True, truncation=True)["input_ids"]
-        generated_ids = self.model.generate(input_ids.to("cuda"), max_new_tokens=128)
-        generated_ids = generated_ids[:, input_ids.shape[-1]:]
-        generated_text = [self.tokenizer.decode(gen_id, skip_special_tokens=True) for gen_id in generated_ids]
-        generated_text = [text.split('\n\n')[0] for text in generated_text]
-        return generated_text
+        return self.engine.generate(prompt)
 
-    def forward_(self, extended_prompt):
-        if len(extended_prompt) > self.max_batch_size:
-            response = []
-            for i in range(0, len(extended_prompt), self.max_batch_size):
-                response += self.forward_(extended_prompt[i:i + self.max_batch_size])
-            return response
-        with torch.no_grad():
-            response = self.run_codellama(extended_prompt)
-        # Clear GPU memory
-        torch.cuda.empty_cache()
-        return response
+    def forward_(self, messages, temperature=None):  # Greedy decoding
+        texts = [self.message_to_text(message) for message in messages]
+        assert all(text.startswith(self.engine.prefix) for text in texts), 'The instruction must not depend on the query'
+        return self.run_codellama([text[len(self.engine.prefix):] for text in texts])
 
 class GeminiModel(BaseModel):
     name = 'gemini'
@@ -1337,7 +1730,25 @@ class GeminiModel(BaseModel):
 
     def __init__(self, gpu_number=0):
         super().__init__(gpu_number=gpu_number)
-        self.model = genai.GenerativeModel('gemini-pro-vision')
+
+        import google.generativeai as genai
+        if os.environ.get('GEMINI_API_KEY') is None:
+            with open('gemini_api.key') as f:
+                genai.configure(api_key=f.read().strip())
+        else:
+            genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
+        self.genai = genai
+
+        self.model_name = 'gemini-pro-vision'
+        self.model = genai.GenerativeModel(self.model_name)
+        # Encoded images of recent requests
+        self.image_cache = LRUCache(max_bytes=config.gemini.image_cache_mb * 2 ** 20, sizeof=lambda x: len(x['data']))
+        # Statistics and the image cache, used from the threads of the consumer
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.counters = Counter()
+        self.latencies = deque(maxlen=1000)
+        self.client = LLMClient(self.name)
         self.safety_setting = [
             {
                 "category": "HARM_CATEGORY_HARASSMENT",
@@ -1357,47 +1768,116 @@ class GeminiModel(BaseModel):
             },
         ]
 
-    def forward(self, image, question=None, task=None):
-        image = copy.deepcopy(image)
+    def encode_image(self, image):
+        """JPEG payload of the image, encoded once per image (by content hash)"""
         if isinstance(image, torch.Tensor):
-            image = torchvision.transforms.ToPILImage()(image)
-
-        assert isinstance(image, Image.Image)
+            key = hash_tensor(image)
+        else:
+            key = hash_tensor(np.asarray(image))
+        with self.lock:  # The cache is shared by the threads of the consumer
+            payload = self.image_cache.get(key)
+        if payload is None:
+            if isinstance(image, torch.Tensor):
+                image = torchvision.transforms.ToPILImage()(image)
+            assert isinstance(image, Image.Image)
+            buffer = io.BytesIO()
+            image.convert('RGB').save(buffer, format='JPEG', quality=config.gemini.jpeg_quality)
+            payload = {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+            with self.lock:
+                self.image_cache.put(key, payload)
+        return payload
+
+    def backoff(self, attempt):
+        """Sleeps (only the thread of this request) with jittered exponential backoff"""
+        delay = min(config.gemini.max_delay, config.gemini.base_delay * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.))
 
+    def forward(self, image, question=None, task=None):
         if question is None:
             question = 'Describe the image in detail'
+        image = self.encode_image(image)
 
-        config = genai.GenerationConfig(
+        generation_config = self.genai.GenerationConfig(
             candidate_count=1, top_p=0.9, temperature=1, max_output_tokens=250
         )
-        retry_count = 3
-        while retry_count > 0:
+        start_time = time.time()
+        answer = None
+        error = None
+        for attempt in range(config.gemini.max_retries + 1):
+            if attempt > 0:
+                self.count('retries')
+                self.backoff(attempt - 1)
             try:
-                response = self.model.generate_content([question, image], generation_config=config, safety_settings=self.safety_setting)
-                break
+                response = self.client.call(self.model.generate_content, [question, image],
+                                            generation_config=generation_config, safety_settings=self.safety_setting,
+                                            usage_of=partial(self.usage_of, question))
             except Exception as e:
                 print(f'Error: {e}')
-                time.sleep(60)
-                retry_count -= 1
-
-        # if block reason = 2 -> skip
-        if response.prompt_feedback.block_reason == response.prompt_feedback.BlockReason.OTHER:
+                error = e
+                continue
+            # if block reason = 2 -> skip
+            if response.prompt_feedback.block_reason == response.prompt_feedback.BlockReason.OTHER:
+                answer = 'No Result'
+                break
+            if response.candidates[0].finish_reason == response.candidates[0].FinishReason.STOP:
+                answer = response.text
+                break
+            # Other finish reasons (e.g. MAX_TOKENS) are retried, sampling another answer
+
+        with self.lock:
+            self.latencies.append(time.time() - start_time)
+            self.num_requests += 1
+        if answer is None:
+            self.count('failures')
+            if error is not None:
+                raise error
             answer = 'No Result'
-        elif response.candidates[0].finish_reason != response.candidates[0].FinishReason.STOP:
-            if response.candidates[0].finish_reason == response.candidates[0].FinishReason.MAX_TOKENS:
-                time.sleep(60)
-            answer = self.forward(image, question=question)
-        else:
-            answer = response.text
-
         return answer
 
+    def usage_of(self, question, response):
+        """Usage reported by the API if available. Otherwise estimated (an image is 258 tokens for Gemini)"""
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_token_count, usage.candidates_token_count
+        else:
+            prompt_tokens = count_tokens(question) + 258
+            try:
+                completion_tokens = count_tokens(response.text)
+            except ValueError:  # Blocked, no text
+                completion_tokens = 0
+        return self.model_name, prompt_tokens, completion_tokens
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = {'requests': self.num_requests, **self.counters}
+        if len(latencies) > 0:
+            stats.update({'latency_mean': float(latencies.mean()), 'latency_p50': float(np.percentile(latencies, 50)),
+                          'latency_p95': float(np.percentile(latencies, 95))})
+        # Per attempt (the latencies above include the retries)
+        stats.update({f'attempt_{k}': v for k, v in self.client.stats().items()})
+        return stats
+
 class BLIPModel(BaseModel):
     name = 'blip'
     to_batch = True
     max_batch_size = 32
     seconds_collect_data = 0.2  # The queue has additionally the time it is executing the previous forward pass
 
+    # Generation parameters for every kind of question. Requests are grouped by profile, so that e.g. a yes/no question
+    # does not pay for the beam search of a long answer in the same batch
+    decoding_profiles = {
+        'qa': dict(length_penalty=-1, num_beams=5, max_length=50, min_length=10, do_sample=False, top_p=0.9,
+                   repetition_penalty=1.0, num_return_sequences=1, temperature=1),
+        'short': dict(num_beams=1, max_length=10, min_length=1, do_sample=False, num_return_sequences=1),
+        'caption': dict(length_penalty=1., num_beams=5, max_length=30, min_length=1, do_sample=False, top_p=0.9,
+                        repetition_penalty=1.0, num_return_sequences=1, temperature=1),
+    }
+
     def __init__(self, gpu_number=1, half_precision=config.blip_half_precision,
                  blip_v2_model_type=config.blip_v2_model_type):
         super().__init__(gpu_number)
@@ -1429,16 +1909,82 @@ class BLIPModel(BaseModel):
                     raise e
 
         self.qa_prompt = "Question: {} Long answer:"
+        self.short_qa_prompt = "Question: {} Short answer:"
         self.caption_prompt = "a photo of"
         self.half_precision = half_precision
         self.max_words = 50
 
+        # Tokens that start a "yes" or a "no" answer, to score yes/no questions without generating
+        is_encoder_decoder = self.model.language_model.config.is_encoder_decoder
+        first_token = lambda w: self.processor.tokenizer(('' if is_encoder_decoder else ' ') + w,
+                                                         add_special_tokens=False).input_ids[0]
+        self.yes_ids = sorted({first_token(w) for w in ['yes', 'Yes']})
+        self.no_ids = sorted({first_token(w) for w in ['no', 'No']})
+
+        # The query embeddings only depend on the image, and programs ask several questions about the same frame
+        self.image_cache = LRUCache(None, max_bytes=config.blip_image_cache_mb * 2 ** 20)
+
+    @torch.no_grad()
+    def image_embeds(self, images):
+        """
+        Runs the vision encoder and the Q-Former, and returns the query embeddings projected to the input space of the
+        language model. They are cached by image content, so further questions about an image only run the language
+        model.
+        """
+        keys = [hash_tensor(im) for im in images]
+        embeds = {k: self.image_cache.get(k) for k in keys}
+        missing = [k for k, e in embeds.items() if e is None]
+        if len(missing) > 0:
+            images_missing = [images[keys.index(k)] for k in missing]
+            pixel_values = self.processor(images=images_missing, return_tensors="pt")['pixel_values']
+            pixel_values = pixel_values.to(self.dev, next(self.model.vision_model.parameters()).dtype)
+            image_embeds = self.model.vision_model(pixel_values, return_dict=True).last_hidden_state
+            image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+            query_tokens = self.model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            query_output = self.model.qformer(query_embeds=query_tokens, encoder_hidden_states=image_embeds,
+                                              encoder_attention_mask=image_attention_mask,
+                                              return_dict=True).last_hidden_state
+            language_model_inputs = self.model.language_projection(query_output)
+            for k, e in zip(missing, language_model_inputs):
+                embeds[k] = e
+                self.image_cache.put(k, e)
+        return torch.stack([embeds[k] for k in keys])
+
+    def prepare_inputs(self, images, text=None):
+        """Returns the input embeddings (query embeddings followed by the text embeddings) and attention mask for the
+        language model"""
+        language_model_inputs = self.image_embeds(images)
+        dev = language_model_inputs.device
+        language_attention_mask = torch.ones(language_model_inputs.size()[:-1], dtype=torch.long, device=dev)
+
+        if text is None:
+            input_ids = torch.LongTensor([[self.model.config.text_config.bos_token_id]]).repeat(len(images), 1)
+            attention_mask = torch.ones_like(input_ids)
+        else:
+            tokenized = self.processor.tokenizer(text, return_tensors="pt", padding="longest")
+            input_ids, attention_mask = tokenized.input_ids, tokenized.attention_mask
+        attention_mask = torch.cat([language_attention_mask, attention_mask.to(dev)], dim=1)
+
+        inputs_embeds = self.model.get_input_embeddings()(input_ids.to(dev))
+        inputs_embeds = torch.cat([language_model_inputs, inputs_embeds.to(language_model_inputs.dtype)], dim=1)
+        return inputs_embeds, attention_mask, language_model_inputs.shape[1]
+
+    @torch.no_grad()
+    def generate(self, images, text=None, **generate_kwargs):
+        """Same as Blip2ForConditionalGeneration.generate, but with the image embeddings from image_embeds"""
+        inputs_embeds, attention_mask, num_query_tokens = self.prepare_inputs(images, text)
+
+        if not self.model.language_model.config.is_encoder_decoder:
+            # The lengths include the query tokens for decoder-only models
+            generate_kwargs['max_length'] = generate_kwargs.get('max_length', 20) + num_query_tokens - 1
+            generate_kwargs['min_length'] = generate_kwargs.get('min_length', 0) + num_query_tokens
+
+        return self.model.language_model.generate(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                                  **generate_kwargs)
+
     @torch.no_grad()
     def caption(self, image, prompt=None):
-        inputs = self.processor(images=image, text=prompt, return_tensors="pt").to(self.dev, torch.float16)
-        generated_ids = self.model.generate(**inputs, length_penalty=1., num_beams=5, max_length=30, min_length=1,
-                                            do_sample=False, top_p=0.9, repetition_penalty=1.0,
-                                            num_return_sequences=1, temperature=1)
+        generated_ids = self.generate(image, prompt, **self.decoding_profiles['caption'])
         generated_text = [cap.strip() for cap in
                           self.processor.batch_decode(generated_ids, skip_special_tokens=True)]
         return generated_text
@@ -1460,17 +2006,34 @@ class BLIPModel(BaseModel):
         return question
 
     @torch.no_grad()
-    def qa(self, image, question):
-        inputs = self.processor(images=image, text=question, return_tensors="pt", padding="longest").to(self.dev)
-        if self.half_precision:
-            inputs['pixel_values'] = inputs['pixel_values'].half()
-        generated_ids = self.model.generate(**inputs, length_penalty=-1, num_beams=5, max_length=50, min_length=10,
-                                            do_sample=False, top_p=0.9, repetition_penalty=1.0,
-                                            num_return_sequences=1, temperature=1)
+    def qa(self, image, question, profile='qa'):
+        generated_ids = self.generate(image, question, **self.decoding_profiles[profile])
         generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
 
         return generated_text
 
+    @torch.no_grad()
+    def yesno(self, image, question):
+        """Answers yes/no questions by comparing the scores of "yes" and "no" as the first generated token"""
+        if not config.blip_yesno_scoring:
+            return self.qa(image, question, profile='short')
+        inputs_embeds, attention_mask, _ = self.prepare_inputs(image, question)
+        language_model = self.model.language_model
+        if language_model.config.is_encoder_decoder:
+            decoder_input_ids = torch.full((len(image), 1), language_model.config.decoder_start_token_id,
+                                           dtype=torch.long, device=inputs_embeds.device)
+            logits = language_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                    decoder_input_ids=decoder_input_ids).logits[:, -1]
+        else:
+            logits = language_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask).logits
+            if self.processor.tokenizer.padding_side == 'left':
+                logits = logits[:, -1]
+            else:
+                last = attention_mask.sum(dim=1) - 1
+                logits = logits[torch.arange(len(image), device=logits.device), last]
+        is_yes = logits[:, self.yes_ids].max(dim=-1).values > logits[:, self.no_ids].max(dim=-1).values
+        return ['yes' if y else 'no' for y in is_yes.tolist()]
+
     def forward(self, image, question=None, task='caption'):
         # start_time = time.time()
         if not self.to_batch:
@@ -1479,21 +2042,25 @@ class BLIPModel(BaseModel):
         if len(image) > 0 and 'float' in str(image[0].dtype) and image[0].max() <= 1:
             image = [im * 255 for im in image]
 
-        # Separate into qa and caption batches.
-        prompts_qa = [self.qa_prompt.format(self.pre_question(q)) for q, t in zip(question, task) if t == 'qa']
-        images_qa = [im for i, im in enumerate(image) if task[i] == 'qa']
-        images_caption = [im for i, im in enumerate(image) if task[i] == 'caption']
+        # Separate into batches with the same decoding profile
+        indices_task = {}
+        for i, t in enumerate(task):
+            indices_task.setdefault(t, []).append(i)
 
+        response = [None] * len(task)
         with torch.cuda.device(self.dev):
-            response_qa = self.qa(images_qa, prompts_qa) if len(images_qa) > 0 else []
-            response_caption = self.caption(images_caption) if len(images_caption) > 0 else []
-
-        response = []
-        for t in task:
-            if t == 'qa':
-                response.append(response_qa.pop(0))
-            else:
-                response.append(response_caption.pop(0))
+            for t, indices in indices_task.items():
+                images_t = [image[i] for i in indices]
+                if t == 'caption':
+                    response_t = self.caption(images_t)
+                elif t == 'yesno':
+                    prompts = [self.short_qa_prompt.format(self.pre_question(question[i])) for i in indices]
+                    response_t = self.yesno(images_t, prompts)
+                else:  # qa
+                    prompts = [self.qa_prompt.format(self.pre_question(question[i])) for i in indices]
+                    response_t = self.qa(images_t, prompts)
+                for i, r in zip(indices, response_t):
+                    response[i] = r
 
         if not self.to_batch:
             response = response[0]
@@ -1507,10 +2074,13 @@ class DeepFaceModel(BaseModel):
     def __init__(self, gpu_number=0):
         super().__init__(gpu_number=gpu_number)
 
+        from deepface import DeepFace  # Imports TensorFlow
+        self.deepface = DeepFace
+
     def forward(self, image, role_face_db: dict):
         try:
             img1 = image.to_uint8_numpy()
-            founded_face = DeepFace.represent(img1, model_name='ArcFace', detector_backend='retinaface')
+            founded_face = self.deepface.represent(img1, model_name='ArcFace', detector_backend='retinaface')
             # print(founded_face)
             if len(founded_face) != 1:
                 return None, role_face_db
@@ -1519,7 +2089,7 @@ class DeepFaceModel(BaseModel):
             embedding1 = founded_face[0]['embedding']
             for pid, face_db in role_face_db.items():
                 for embedding2 in face_db:
-                    response = DeepFace.verify(img1_path=embedding1, img2_path=embedding2, detector_backend='retinaface', model_name='ArcFace', silent=True)
+                    response = self.deepface.verify(img1_path=embedding1, img2_path=embedding2, detector_backend='retinaface', model_name='ArcFace', silent=True)
                     # print(response)
                     if response['verified'] and response['distance'] < min_dist:
                         min_pid = pid
@@ -1549,30 +2119,42 @@ class SaliencyModel(BaseModel):
         # These parameters are for the Plus Ultra LR model
         super().__init__(gpu_number)
         depth = 64
-        pretrained = True
+        pretrained = False  # The backbone weights are also in the checkpoint, loaded below
         base_size = [384, 384]
         kwargs = {'name': 'InSPyReNet_SwinB', 'threshold': 512}
         # with HiddenPrints("Saliency"):
         model = InSPyReNet(SwinB(pretrained=pretrained, path_pretrained_models=config.path_pretrained_models),
                             [128, 128, 256, 512, 1024], depth, base_size, **kwargs)
-        model.load_state_dict(torch.load(os.path.join(path_checkpoint, 'latest.pth'),
-                                            map_location=torch.device('cpu')), strict=True)
+        load_inference_weights(model, os.path.join(path_checkpoint, 'latest.pth'), self.dev, strict=True)
         model = model.to(self.dev)
         model.eval()
 
         self.model = model
         self.transform_pil = transforms.ToPILImage()
-        self.transform = get_transform({
-            'static_resize': {'size': [384, 384]},
-            'dynamic_resize': {'L': 1280},
-            'tonumpy': None,
-            'normalize': {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]},
-            'totensor': None
-        })
+
+        def build_transform(size):
+            return get_transform({
+                'static_resize': {'size': [size, size]},
+                'dynamic_resize': {'L': 1280, 'base_size': [size, size]},
+                'tonumpy': None,
+                'normalize': {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]},
+                'totensor': None
+            })
+
+        self.base_size = base_size[0]
+        self.build_transform = build_transform
+        self.transforms_per_size = {self.base_size: build_transform(self.base_size)}
+
+    def get_transform(self, image):
+        # The input is resized to a square, so the larger side decides how much it gets upscaled
+        size = inference_size(max(image.shape[1:]), self.base_size, config.saliency.max_upscale)
+        if size not in self.transforms_per_size:
+            self.transforms_per_size[size] = self.build_transform(size)
+        return self.transforms_per_size[size]
 
     @torch.no_grad()
     def forward(self, image):
-        image_t = self.transform({'image': self.transform_pil(image)})
+        image_t = self.get_transform(image)({'image': self.transform_pil(image)})
         image_t['image_resized'] = image_t['image_resized'].unsqueeze(0).to(self.dev)
         image_t['image'] = image_t['image'].unsqueeze(0).to(self.dev)
         pred = self.model(image_t)['pred']
@@ -1616,9 +2198,8 @@ class XVLMModel(BaseModel):
         }
         # with warnings.catch_warnings(), HiddenPrints("XVLM"):
         model = XVLMBase(config_xvlm, use_contrastive_loss=True, vision_config=vision_config)
-        checkpoint = torch.load(path_checkpoint, map_location='cpu')
-        state_dict = checkpoint['model'] if 'model' in checkpoint.keys() else checkpoint
-        msg = model.load_state_dict(state_dict, strict=False)
+        msg = load_inference_weights(model, path_checkpoint, self.dev, strict=False,
+                                     prepare_state_dict=lambda ck: ck['model'] if 'model' in ck.keys() else ck)
         if len(msg.missing_keys) > 0:
             print('XVLM Missing keys: ', msg.missing_keys)
 
@@ -3,28 +3,107 @@ This is the script that contains the backend code. No need to look at this to im
 Functions that run separate processes. These processes run on GPUs, and are queried by processes running only CPUs
 """
 
+import contextlib
 import dill
+import gc
 import inspect
+import os
 import queue
+import signal
+import threading
 import torch
 import torch.multiprocessing as mp
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import DictProxy, SyncManager
 from rich.console import Console
-from time import time
+from time import sleep, time
 from typing import Callable, Union
 
 from configs import config
+from llm_client import Metered, add_usage, metering, total_usage, unwrap, without_usage
+from placement import footprint_gb, model_classes, plan_models, record_measurement
+from replay import RequestStore, clear_misses, report_misses
+from utils import LRUCache, hash_inputs
 
 console = Console(highlight=False)
 
-if mp.current_process().name == 'MainProcess':
+# The consumers can also run in a long-lived model server (model_server.py) that other runs attach to, using the same
+# forward() API. The input queues of the consumers and the status of the server live in the manager of the server.
+_server_queues = {}
+_server_state = {}
+
+
+def _get_server_queue(name):
+    if name not in _server_queues:
+        _server_queues[name] = queue.Queue()
+    return _server_queues[name]
+
+
+def _get_server_state():
+    return _server_state
+
+
+class ModelServerManager(SyncManager):
+    pass
+
+
+ModelServerManager.register('get_queue_in', callable=_get_server_queue)
+ModelServerManager.register('get_state', callable=_get_server_state, proxytype=DictProxy)
+
+
+def model_server_address():
+    """config.model_server.address as a (host, port) tuple, or as is if it is the path of a unix socket"""
+    address = config.model_server.address
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def model_server_manager():
+    # Processes started from here (consumers or program workers) inherit the key, which they need to use the queues
+    mp.current_process().authkey = config.model_server.authkey.encode()
+    return ModelServerManager(address=model_server_address(), authkey=config.model_server.authkey.encode())
+
+
+model_server_client = bool(config.model_server.address) and not config.model_server.serve
+server_state = None
+server_state_checked = 0.  # Last time the state of the server was read
+
+
+def check_server_state():
+    """Raises if the model server stopped accepting requests. The state is read at most every health_interval seconds,
+    as every read is a round trip to the server"""
+    global server_state_checked
+    if server_state is None or time() - server_state_checked < config.model_server.health_interval:
+        return
+    if server_state.get('state') != 'serving':
+        raise RuntimeError(f'The model server at {config.model_server.address} is not accepting requests')
+    server_state_checked = time()
+
+# Record the requests and their outputs, or serve them from a previous recording without loading the models
+request_store = RequestStore(config.record_replay.path) if config.record_replay.mode else None
+replaying = config.record_replay.mode == 'replay'
+if replaying and mp.current_process().name == 'MainProcess':
+    clear_misses(config.record_replay.path)
+
+if mp.current_process().name == 'MainProcess' and model_server_client:
+    # The models are already loaded in the model server. Just attach to it
+    list_models = None
+    manager = model_server_manager()
+    manager.connect()
+    server_state = manager.get_state()
+    check_server_state()
+elif mp.current_process().name == 'MainProcess':
     # No need to initialize the models inside each process
-    import vision_models
-    # Create a list of all the defined models
-    list_models = [m[1] for m in inspect.getmembers(vision_models, inspect.isclass)
-                   if issubclass(m[1], vision_models.BaseModel) and m[1] != vision_models.BaseModel]
-    # Sort by attribute "load_order"
-    list_models.sort(key=lambda x: x.load_order)
-    if config.multiprocessing:
+    # Create a list of all the defined models, sorted by attribute "load_order"
+    list_models = model_classes()
+    if config.model_server.serve:
+        assert config.multiprocessing, 'The model server runs every model in its own process'
+        manager = model_server_manager()
+        manager.start()
+    elif config.multiprocessing:
         manager = mp.Manager()
     else:
         manager = None
@@ -33,16 +112,207 @@ else:
     manager = None
 
 
-def make_fn(model_class, process_name, counter):
+def gpu_memory_allocated():
+    if not torch.cuda.is_available():
+        return 0
+    return sum(torch.cuda.memory_allocated(i) for i in range(torch.cuda.device_count()))
+
+
+def gpu_memory_free(gpu_number):
+    if not torch.cuda.is_available():
+        return float('inf')
+    return torch.cuda.mem_get_info(gpu_number)[0]
+
+
+def attributes_of_type(obj, cls, depth=2):
+    """Attributes of obj that are instances of cls, also looking inside other attributes up to some depth (e.g. the
+    torch.nn.Module inside the GLIP demo)"""
+    found = []
+    for v in vars(obj).values():
+        if isinstance(v, cls):
+            found.append(v)
+        elif depth > 1 and hasattr(v, '__dict__') and not isinstance(v, (type, torch.nn.Module)):
+            found += attributes_of_type(v, cls, depth - 1)
+    return found
+
+
+class LazyModel:
+    """
+    Holds the instance of a model. If config.lazy_loading.enabled, the model is only created on its first request.
+    The models loaded in the process are tracked, so that the least recently used ones can be offloaded to CPU or
+    dropped when a model that is being loaded does not fit in GPU memory, or after being idle for
+    config.lazy_loading.idle_seconds. In multiprocessing mode every consumer runs in its own process, so only the idle
+    eviction applies across models. Models that are computing (in_flight calls) are never evicted.
+    """
+    loaded: OrderedDict = OrderedDict()  # process_name -> LazyModel, least recently used first
+
+    def __init__(self, model_class, process_name, gpu_number=None):
+        self.model_class = model_class
+        self.process_name = process_name
+        self.gpu_number = gpu_number
+        self.instance = None
+        self.offloaded = False
+        self.last_used = time()
+        footprint = footprint_gb(process_name)
+        self.footprint = None if footprint is None else footprint * 2 ** 30  # In bytes
+        # Time spent computing, for the placement planner of later runs
+        self.calls = 0
+        self.busy_seconds = 0.
+        self.lock = threading.Lock()  # Consumers of API models call the model from several threads
+        self.in_flight = 0  # Calls being computed
+
+    @property
+    def device_index(self):
+        """GPU where the model is loaded: the planned one, or the default of its class"""
+        if self.gpu_number is not None:
+            return self.gpu_number
+        default = inspect.signature(self.model_class.__init__).parameters.get('gpu_number', None)
+        return 0 if default is None or default.default is inspect.Parameter.empty else default.default
+
+    @contextlib.contextmanager
+    def use(self):
+        """The instance of the model, loaded if needed. It is not evicted until the block ends"""
+        with self.lock:
+            if self.instance is None:
+                self.load()
+            elif self.offloaded:
+                self.restore()
+            LazyModel.loaded.move_to_end(self.process_name)
+            self.in_flight += 1
+            instance = self.instance
+        try:
+            yield instance
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.last_used = time()
+
+    def load(self):
+        self.make_room()
+        start_time = time()
+        memory_before = gpu_memory_allocated()
+        try:
+            if self.gpu_number is None:
+                self.instance = self.model_class()
+            else:
+                self.instance = self.model_class(gpu_number=self.gpu_number)
+        except torch.cuda.OutOfMemoryError:
+            self.instance = None
+            if not self.evict_lru():
+                raise
+            return self.load()
+        self.footprint = gpu_memory_allocated() - memory_before
+        LazyModel.loaded[self.process_name] = self
+        console.print(f'Loaded {self.process_name} in {time() - start_time:.1f}s '
+                      f'({self.footprint / 2 ** 30:.2f}GB of GPU memory)')
+        if self.footprint > 0:
+            record_measurement(self.process_name, footprint_gb=self.footprint / 2 ** 30)
+
+    def record_call(self, seconds):
+        self.calls += 1
+        self.busy_seconds += seconds
+        if self.calls % config.log_every == 0:
+            record_measurement(self.process_name, busy_seconds=self.busy_seconds, calls=self.calls)
+
+    def restore(self):
+        self.make_room()
+        start_time = time()
+        for module in attributes_of_type(self.instance, torch.nn.Module):
+            module.to(self.instance.dev)
+        self.offloaded = False
+        LazyModel.loaded[self.process_name] = self
+        console.print(f'Restored {self.process_name} to {self.instance.dev} in {time() - start_time:.1f}s')
+
+    def make_room(self):
+        """Evict other models until there is enough free memory in the GPU of this one, if its footprint is known"""
+        if self.footprint is None:
+            return
+        while gpu_memory_free(self.device_index) < self.footprint and self.evict_lru():
+            pass
+
+    def evict_lru(self):
+        """Evicts the least recently used model in the same GPU that is not computing. Returns whether there was one"""
+        for process_name, lazy_model in list(LazyModel.loaded.items()):
+            if lazy_model is self or lazy_model.device_index != self.device_index:
+                continue
+            # Not blocking: the lock of a model is held while it loads, and this one holds its own
+            if lazy_model.lock.acquire(blocking=False):
+                try:
+                    if lazy_model.in_flight == 0 and lazy_model.instance is not None and not lazy_model.offloaded:
+                        lazy_model.evict()
+                        return True
+                finally:
+                    lazy_model.lock.release()
+        return False
+
+    def evict(self, mode=None):
+        mode = config.lazy_loading.evict_mode if mode is None else mode
+        modules = attributes_of_type(self.instance, torch.nn.Module)
+        if mode == 'cpu' and any(getattr(m, 'hf_device_map', None) is not None for m in modules):
+            mode = 'drop'  # Models dispatched with a device map (e.g. 8 bit) cannot be moved
+        if mode == 'cpu':
+            for module in modules:
+                module.to('cpu')
+            # Cached GPU tensors (e.g. features of recent images) are not needed to run the model
+            for lru_cache in attributes_of_type(self.instance, LRUCache):
+                lru_cache.clear()
+            self.offloaded = True
+        else:
+            self.instance = None
+            self.offloaded = False
+        LazyModel.loaded.pop(self.process_name, None)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        console.print(f'Evicted {self.process_name} ({mode})')
+
+    def evict_if_idle(self):
+        idle_seconds = config.lazy_loading.idle_seconds
+        if idle_seconds is None:
+            return
+        with self.lock:
+            if self.process_name in LazyModel.loaded and self.in_flight == 0 and \
+                    time() - self.last_used > idle_seconds:
+                self.evict()
+
+    @classmethod
+    def evict_idle(cls):
+        for lazy_model in list(cls.loaded.values()):
+            lazy_model.evict_if_idle()
+
+    @classmethod
+    def start_idle_eviction(cls):
+        """Evicts the idle models from a background thread. For the models that share the process (no
+        multiprocessing). The consumer processes evict their model when they have no requests"""
+        idle_seconds = config.lazy_loading.idle_seconds
+        if idle_seconds is None:
+            return
+
+        def sweep():
+            while True:
+                sleep(idle_seconds / 2)
+                cls.evict_idle()
+
+        threading.Thread(target=sweep, daemon=True).start()
+
+
+def plan_gpus():
+    """
+    GPU of every replica of the models to load (process_name -> list of GPU numbers), from the placement planner.
+    Models that do not require a GPU get None. Returns None if there is nothing to plan (placement disabled or no GPUs)
+    """
+    return plan_models(list_models, config.multiprocessing)
+
+
+def make_fn(model_class, process_name, gpu_number=None, model_stats=None):
     """
     model_class.name and process_name will be the same unless the same model is used in multiple processes, for
-    different tasks
+    different tasks. If gpu_number is None, the model uses the default GPU of its class. The counters of the model
+    (model.stats()) are kept up to date in model_stats
     """
-    # We initialize each one on a separate GPU, to make sure there are no out of memory errors
-    num_gpus = torch.cuda.device_count()
-    gpu_number = counter % num_gpus
-    # model_instance = model_class(gpu_number=gpu_number)
-    model_instance = model_class()
+    lazy_model = LazyModel(model_class, process_name, gpu_number)
+    if not config.lazy_loading.enabled:
+        lazy_model.load()
 
     def _function(*args, **kwargs):
         if process_name != model_class.name:
@@ -54,7 +324,7 @@ def make_fn(model_class, process_name, counter):
             kwargs = {k: [v] for k, v in kwargs.items()}
 
             # The defaults that are not in args or kwargs, also need to listify
-            full_arg_spec = inspect.getfullargspec(model_instance.forward)
+            full_arg_spec = inspect.getfullargspec(model_class.forward)
             if full_arg_spec.defaults is None:
                 default_dict = {}
             else:
@@ -64,160 +334,449 @@ def make_fn(model_class, process_name, counter):
             for arg_name in non_given_args:
                 kwargs[arg_name] = [default_dict[arg_name]]
 
-        try:
-            out = model_instance.forward(*args, **kwargs)
-            if model_class.to_batch and not config.multiprocessing:
-                out = out[0]
-        except Exception as e:
-            print(f'Error in {process_name} model:', e)
-            out = None
+        start_time = time()
+        model_instance = None
+        with metering() as usage:
+            try:
+                # Loading the model (and evicting others to make room) can fail too. Only this request fails then
+                with lazy_model.use() as model_instance:
+                    out = model_instance.forward(*args, **kwargs)
+                if model_class.to_batch and not config.multiprocessing:
+                    out = out[0]
+            except Exception as e:
+                print(f'Error in {process_name} model:', e)
+                out = None
+        lazy_model.record_call(time() - start_time)
+        if len(usage) > 0 and not model_class.to_batch:
+            # Language model usage, attributed to the caller by forward()
+            out = Metered(out, {process_name: dict(total_usage(usage))})
+        if model_stats is not None and model_instance is not None:
+            current_stats = model_instance.stats()
+            if len(current_stats) > 0:
+                model_stats[process_name] = current_stats
         return out
 
+    _function.lazy_model = lazy_model
     return _function
 
 
-if config.multiprocessing:
+class RequestCoalescer:
+    """
+    Input of a consumer that computes identical requests (same inputs, with images compared by content) only once,
+    and sends the result to all of them. This is not a cache: requests are only coalesced while they are pending, that
+    is, if they are in the same batch, or among the next config.coalesce_lookahead requests in the queue when the
+    result of an identical request is ready (API model consumers, which compute many requests at the same time, also
+    join requests that are being computed). The lookahead is bounded so that the replicas of a model, which read from
+    the same queue, still share the queued requests. The number of coalesced requests of every consumer process is
+    kept in `stats` (see coalesced_requests). The time that the recent requests waited in the queue is kept in `queue_stats` (one list of seconds per
+    consumer process).
+    """
+
+    def __init__(self, queue_in, process_name, stats=None, queue_stats=None):
+        self.queue_in = queue_in
+        self.process_name = process_name
+        self.stats = stats
+        self.queue_stats = queue_stats
+        self.pending = deque()  # (received, key) taken from the queue while looking for identical requests
+        self.ending = False  # The end signal is in pending
+        self.coalesced = 0
+        self.received = 0
+        self.waits = deque(maxlen=1000)
+
+    def get(self, timeout=None):
+        """Next request, and its key (None for requests that are not coalesced, and for the end signal)"""
+        if len(self.pending) > 0:
+            received, key = self.pending.popleft()
+        else:
+            received = self.queue_in.get(timeout=timeout)
+            key = None if received is None else self.key(received[0])
+        self.record_wait(received)
+        return received, key
+
+    def record_wait(self, received):
+        if received is not None and len(received) > 2:  # Sent with the time it was sent
+            self.waits.append(time() - received[2])
+            self.received += 1
+        if self.queue_stats is not None and (received is None or self.received % config.log_every == 0):
+            self.queue_stats[f'{self.process_name}/{os.getpid()}'] = list(self.waits)
+
+    @staticmethod
+    def key(inputs):
+        if not config.coalesce_requests:
+            return None
+        try:
+            return hash_inputs(inputs)
+        except Exception:  # Inputs that cannot be hashed are never coalesced
+            return None
+
+    def count(self, n=1):
+        self.coalesced += n
+        if self.stats is not None:  # Every replica writes its own key, so that there is no read-modify-write
+            self.stats[f'{self.process_name}/{os.getpid()}'] = self.coalesced
+
+    def serve_pending(self, results: dict):
+        """Sends the results (key -> output) just computed to the identical requests that are waiting: the ones already
+        taken from the queue, and the next ones in the queue, up to config.coalesce_lookahead pending requests"""
+        if not config.coalesce_requests or len(results) == 0:
+            return
+        pending = deque()
+        for received, key in self.pending:
+            if key is not None and key in results:
+                received[1].put(without_usage(results[key]))
+                self.count()
+            else:
+                pending.append((received, key))
+        self.pending = pending
+        # Nothing is taken after the end signal: the rest of the queue is for the other replicas
+        while len(self.pending) < config.coalesce_lookahead and not self.ending:
+            try:
+                received = self.queue_in.get_nowait()
+            except queue.Empty:
+                break
+            key = None if received is None else self.key(received[0])
+            if key is not None and key in results:
+                received[1].put(without_usage(results[key]))
+                self.count()
+            else:
+                self.pending.append((received, key))
+                self.ending = received is None
+
+
+if config.multiprocessing or model_server_client:
 
-    def make_fn_process(model_class, process_name, counter):
+    def make_fn_process(model_class, process_name, gpu_number=None, serving=False):
+        """
+        Function that runs the consumer of process_name in its own process. With serving (the consumers of the model
+        server), the consumer ignores SIGINT: the server stops it once the queued requests are finished. It is passed
+        explicitly because the consumer processes load the config again from the files
+        """
 
         if model_class.to_batch:
             seconds_collect_data = model_class.seconds_collect_data  # Window of seconds to group inputs
             max_batch_size = model_class.max_batch_size
 
-            def _function(queue_in):
+            def _function(queue_in, stats=None, model_stats=None, queue_stats=None):
+                if serving:
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The server stops the consumers once drained
 
-                fn = make_fn(model_class, process_name, counter)
+                fn = make_fn(model_class, process_name, gpu_number, model_stats)
+                requests = RequestCoalescer(queue_in, process_name, stats, queue_stats)
 
                 to_end = False
                 while True:
                     start_time = time()
                     time_left = seconds_collect_data
                     batch_inputs = []
-                    batch_queues = []
+                    batch_queues = []  # For every input, the queues of all the requests with that input
+                    batch_keys = {}
                     while time_left > 0 and len(batch_inputs) < max_batch_size:
                         try:
-                            received = queue_in.get(timeout=time_left)
+                            received, key = requests.get(timeout=time_left)
                             if received is None:
                                 to_end = True
                                 break
+                            if key is not None and key in batch_keys:
+                                batch_queues[batch_keys[key]].append(received[1])
+                                requests.count()
                             else:
+                                if key is not None:
+                                    batch_keys[key] = len(batch_inputs)
                                 batch_inputs.append(received[0])
-                                batch_queues.append(received[1])
+                                batch_queues.append([received[1]])
                         except queue.Empty:  # Time-out expired
                             break  # Break inner loop (or do nothing, would break anyway because time_left < 0)
                         time_left = seconds_collect_data - (time() - start_time)
-                    if len(batch_inputs) > 0:
+                    if len(batch_inputs) == 0:
+                        fn.lazy_model.evict_if_idle()
+                    else:
                         batch_kwargs = collate(batch_inputs, model_class.forward)
                         outs = fn(**batch_kwargs)
                         try:
-                            for out, qu in zip(outs, batch_queues):
-                                qu.put(out)
+                            for out, qus in zip(outs, batch_queues):
+                                for qu in qus:
+                                    qu.put(out)
+                            requests.serve_pending({key: outs[i] for key, i in batch_keys.items()})
                         except Exception as e:
                             # No message, because we are just carrying the error from before
-                            for qu in batch_queues:
-                                qu.put(None)
+                            for qus in batch_queues:
+                                for qu in qus:
+                                    qu.put(None)
                     if to_end:
                         print(f'{process_name} model exiting')
                         break
 
+        elif (not model_class.requires_gpu or model_class.concurrent_requests) and config.api_threads > 1:
+            # API models spend their time waiting for the responses, so many requests are serviced at the same time.
+            # Also models that batch concurrent requests by themselves (concurrent_requests)
+            def _function(queue_in, stats=None, model_stats=None, queue_stats=None):
+                if serving:
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The server stops the consumers once drained
+
+                fn = make_fn(model_class, process_name, gpu_number, model_stats)
+                requests = RequestCoalescer(queue_in, process_name, stats, queue_stats)
+                executor = ThreadPoolExecutor(max_workers=config.api_threads, thread_name_prefix=process_name)
+                waiting = {}  # Key of the requests being computed -> result queues of all the identical requests
+                lock = threading.Lock()
+
+                def run(args, kwargs, queue_out, key):
+                    # Errors outside model.forward (e.g. the stats) must not leave the callers waiting: every
+                    # identical request waiting for this one gets an output, and the key is released
+                    out = None
+                    try:
+                        out = fn(*args, **kwargs)
+                    except Exception as e:
+                        print(f'Error in {process_name} consumer:', e)
+                    finally:
+                        with lock:
+                            queues_out = [queue_out] if key is None else waiting.pop(key, [queue_out])
+                        for i, qu in enumerate(queues_out):
+                            qu.put(out if i == 0 else without_usage(out))
+
+                while True:
+                    try:
+                        received, key = requests.get(timeout=config.lazy_loading.idle_seconds)
+                    except queue.Empty:
+                        fn.lazy_model.evict_if_idle()
+                        continue
+                    if received is None:
+                        executor.shutdown(wait=True)
+                        print(f'{process_name} exiting')
+                        return
+                    (args, kwargs), queue_out = received[:2]
+                    with lock:
+                        if key is not None and key in waiting:
+                            waiting[key].append(queue_out)
+                            requests.count()
+                            continue
+                        if key is not None:
+                            waiting[key] = [queue_out]
+                    executor.submit(run, args, kwargs, queue_out, key)
+
         else:
-            def _function(queue_in):
-                fn = make_fn(model_class, process_name, counter)
+            def _function(queue_in, stats=None, model_stats=None, queue_stats=None):
+                if serving:
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The server stops the consumers once drained
+
+                fn = make_fn(model_class, process_name, gpu_number, model_stats)
+                requests = RequestCoalescer(queue_in, process_name, stats, queue_stats)
                 while True:
-                    received = queue_in.get()
+                    try:
+                        received, key = requests.get(timeout=config.lazy_loading.idle_seconds)
+                    except queue.Empty:
+                        fn.lazy_model.evict_if_idle()
+                        continue
                     if received is None:
                         print(f'{process_name} exiting')
                         return
-                    (args, kwargs), queue_out = received
+                    (args, kwargs), queue_out = received[:2]
                     out = fn(*args, **kwargs)
                     queue_out.put(out)
+                    if key is not None:
+                        requests.serve_pending({key: out})
 
         return _function
 
 
-    if mp.current_process().name == 'MainProcess':
+    if mp.current_process().name == 'MainProcess' and model_server_client:
+        queues_in: Union[dict[str, mp.Queue], None] = \
+            {process_name_: manager.get_queue_in(process_name_) for process_name_ in server_state.get('models')}
+        consumers: dict[str, Union[mp.Process, Callable]] = dict()
+        request_stats = None
+        model_stats = None
+        queue_stats = None
+
+    elif mp.current_process().name == 'MainProcess':
         queues_in: Union[dict[str, mp.Queue], None] = dict()
         consumers: dict[str, Union[mp.Process, Callable]] = dict()
+        request_stats = manager.dict()  # Number of coalesced requests per consumer process
+        model_stats = manager.dict()  # Counters reported by the models (BaseModel.stats)
+        queue_stats = manager.dict()  # Seconds that the recent requests waited in the queue, per consumer process
 
-        counter_ = 0
+        gpu_plan = plan_gpus()
         for model_class_ in list_models:
             for process_name_ in model_class_.list_processes():
-                if process_name_ in config.load_models and config.load_models[process_name_]:
-                    queue_in_ = manager.Queue()  # For transfer of data from producer to consumer
+                if process_name_ in config.load_models and config.load_models[process_name_] and not replaying:
+                    # For transfer of data from producer to consumer
+                    queue_in_ = manager.get_queue_in(process_name_) if config.model_server.serve else manager.Queue()
                     queues_in[process_name_] = queue_in_
 
-                    fn_process = make_fn_process(model_class_, process_name_, counter_)
-                    # Otherwise, it is not possible to pickle the _function (not defined at top level)
-                    aux = mp.reducer.dump
-                    mp.reducer.dump = dill.dump
-                    consumer = mp.Process(target=fn_process, kwargs={'queue_in': queue_in_})
-                    consumer.start()
-                    mp.reducer.dump = aux
-                    consumers[process_name_] = consumer
-
-                    counter_ += 1
+                    # Replicas of a model read from the same queue
+                    gpu_numbers = [None] if gpu_plan is None else gpu_plan[process_name_]
+                    for replica, gpu_number_ in enumerate(gpu_numbers):
+                        fn_process = make_fn_process(model_class_, process_name_, gpu_number_,
+                                                     serving=config.model_server.serve)
+                        # Otherwise, it is not possible to pickle the _function (not defined at top level)
+                        aux = mp.reducer.dump
+                        mp.reducer.dump = dill.dump
+                        consumer = mp.Process(target=fn_process,
+                                              kwargs={'queue_in': queue_in_, 'stats': request_stats,
+                                                      'model_stats': model_stats, 'queue_stats': queue_stats})
+                        consumer.start()
+                        mp.reducer.dump = aux
+                        consumers[process_name_ if replica == 0 else f'{process_name_}/{replica}'] = consumer
+
+        if config.model_server.serve:
+            manager.get_state().update({'models': list(queues_in.keys()), 'state': 'serving'})
 
     else:
         queues_in = None
+        request_stats = None
+        model_stats = None
+        queue_stats = None
 
 
     def finish_all_consumers():
-        # Wait for consumers to finish
-        for q_in in queues_in.values():
-            q_in.put(None)
+        if model_server_client:
+            return  # The server keeps the models for other runs
+        # Wait for consumers to finish. Every replica of a model takes one None from the queue of the model
+        for consumer_name in consumers:
+            queues_in[consumer_name.split('/')[0]].put(None)
         for cons in consumers.values():
             cons.join()
+        if len(request_stats) > 0:
+            console.print(f'Coalesced requests: {coalesced_requests(request_stats)}')
+        for process_name, process_stats in model_stats.items():
+            console.print(f'{process_name}: {process_stats}')
+        print_replay_misses()
 
 else:
 
     consumers = dict()
 
-    counter_ = 0
+    model_stats = dict()  # Counters reported by the models (BaseModel.stats)
+    queue_stats = dict()  # The models are called directly, without queues
+    gpu_plan = plan_gpus()
     for model_class_ in list_models:
         for process_name_ in model_class_.list_processes():
-            if process_name_ in config.load_models and config.load_models[process_name_]:
-                consumers[process_name_] = make_fn(model_class_, process_name_, counter_)
-                counter_ += 1
+            if process_name_ in config.load_models and config.load_models[process_name_] and not replaying:
+                gpu_number_ = None if gpu_plan is None else gpu_plan[process_name_][0]
+                consumers[process_name_] = make_fn(model_class_, process_name_, gpu_number_, model_stats)
+    LazyModel.start_idle_eviction()
 
     queues_in = None
 
     def finish_all_consumers():
-        pass
+        for process_name, process_stats in model_stats.items():
+            console.print(f'{process_name}: {process_stats}')
+        print_replay_misses()
+
+
+def coalesced_requests(stats) -> dict:
+    """Number of coalesced requests of every model (the sum over its replicas), from the stats of the consumers"""
+    coalesced = {}
+    for key, n in dict(stats).items():
+        process_name = key.split('/')[0]
+        coalesced[process_name] = coalesced.get(process_name, 0) + n
+    return coalesced
+
+
+def print_replay_misses():
+    if replaying:
+        misses = report_misses(config.record_replay.path)
+        if len(misses) > 0:
+            console.print(f'Requests not found in the recording (not computed): {dict(misses)}')
+        else:
+            console.print('All the requests were served from the recording')
+
+
+class TaggedQueue:
+    """Result queue that tags every result, so that several requests can share the same queue (see forward_many)"""
+
+    def __init__(self, queue_results, tag):
+        self.queue_results = queue_results
+        self.tag = tag
+
+    def put(self, out):
+        self.queue_results.put((self.tag, out))
+
+
+def consumer_queues(model_name, queues=None):
+    """Input queue of the consumer of model_name, and the queue to get the results"""
+    if queues is None:
+        consumer_queues_in, queue_results = None, None
+    else:
+        consumer_queues_in, queue_results = queues
+    try:
+        if consumer_queues_in is not None:
+            consumer_queue_in = consumer_queues_in[model_name]
+        else:
+            consumer_queue_in = queues_in[model_name]
+    except KeyError as e:
+        options = list(consumer_queues_in.keys()) if consumer_queues_in is not None else list(queues_in.keys())
+        raise KeyError(f'No model named {model_name}. The available models are: {options}. '
+                       f'Make sure to activate it in the configs files') from e
+    if queue_results is None:
+        # print('No queue exists to get results. Creating a new one, but this is inefficient. '
+        #       'Consider providing an existing queue for the process')
+        queue_results = manager.Queue()  # To get outputs
+    return consumer_queue_in, queue_results
 
 
 def forward(model_name, *args, queues=None, **kwargs):
     """
     Sends data to consumer (calls their "forward" method), and returns the result
     """
-    error_msg = f'No model named {model_name}. ' \
-                'The available models are: {}. Make sure to activate it in the configs files'
-    if not config.multiprocessing:
+    if replaying:
+        return request_store.replay(model_name, args, kwargs)
+    check_server_state()
+    if not config.multiprocessing and not model_server_client:
         try:
             out = consumers[model_name](*args, **kwargs)
         except KeyError as e:
-            raise KeyError(error_msg.format(list(consumers.keys()))) from e
+            raise KeyError(f'No model named {model_name}. The available models are: {list(consumers.keys())}. '
+                           f'Make sure to activate it in the configs files') from e
     else:
-        if queues is None:
-            consumer_queues_in, queue_results = None, None
-        else:
-            consumer_queues_in, queue_results = queues
-        try:
-            if consumer_queues_in is not None:
-                consumer_queue_in = consumer_queues_in[model_name]
-            else:
-                consumer_queue_in = queues_in[model_name]
-        except KeyError as e:
-            options = list(consumer_queues_in.keys()) if consumer_queues_in is not None else list(queues_in.keys())
-            raise KeyError(error_msg.format(options)) from e
-        if queue_results is None:
-            # print('No queue exists to get results. Creating a new one, but this is inefficient. '
-            #       'Consider providing an existing queue for the process')
-            queue_results = manager.Queue()  # To get outputs
-        consumer_queue_in.put([(args, kwargs), queue_results])
+        consumer_queue_in, queue_results = consumer_queues(model_name, queues)
+        consumer_queue_in.put([(args, kwargs), queue_results, time()])
         out = queue_results.get()  # Wait for result
+    out = unwrap(out)
+    if request_store is not None:
+        request_store.record(model_name, args, kwargs, out)
     return out
 
 
+def forward_many(model_name, inputs: list, queues=None):
+    """
+    Sends several requests to the same consumer at once, so that they are computed concurrently (or batched), and
+    returns their results in order. `inputs` is a list of (args, kwargs). The results come back through the result
+    queue of the process, tagged with the position of the request.
+    """
+    if replaying:
+        return [forward(model_name, *args, **kwargs) for args, kwargs in inputs]
+    check_server_state()
+    if len(inputs) == 0:
+        return []
+    if not config.multiprocessing and not model_server_client:
+        if model_name in consumers and not consumers[model_name].lazy_model.model_class.requires_gpu:
+            def run(x):
+                with metering() as usage:
+                    return forward(model_name, *x[0], **x[1]), usage
+            with ThreadPoolExecutor(max_workers=config.api_threads) as executor:
+                results = list(executor.map(run, inputs))
+            for _, usage in results:  # Measured in the threads, added to the meter of this one
+                add_usage(usage)
+            return [out for out, _ in results]
+        return [forward(model_name, *args, **kwargs) for args, kwargs in inputs]
+    consumer_queue_in, queue_results = consumer_queues(model_name, queues)
+    for i, (args, kwargs) in enumerate(inputs):
+        consumer_queue_in.put([(args, kwargs), TaggedQueue(queue_results, i), time()])
+    outs = [None] * len(inputs)
+    for _ in range(len(inputs)):
+        i, out = queue_results.get()
+        outs[i] = unwrap(out)
+        if request_store is not None:
+            request_store.record(model_name, *inputs[i], outs[i])
+    return outs
+
+
+def health():
+    """Status of the model server this process is attached to: state, uptime, whether every consumer is alive, and the
+    number of queued requests per model"""
+    if not model_server_client:
+        raise RuntimeError('Not attached to a model server. Set config.model_server.address')
+    return server_state.copy()
+
+
 def collate(batch_inputs, fn):
     """
     Combine a list of inputs into a single dictionary. The dictionary contains all the parameters of the